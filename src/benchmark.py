@@ -0,0 +1,324 @@
+"""Benchmarks of the pipeline on synthetic station files, so performance can
+be measured without the real data.
+
+Run with e.g.
+    python src/benchmark.py --stations 20 --samples 72000 --output bench.json
+and compare two runs with
+    python src/benchmark.py --compare old.json new.json
+The startup time of main.py alone is measured with
+    python src/benchmark.py --startup
+"""
+import os
+import sys
+import json
+import shutil
+import time
+import argparse
+import datetime
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+
+import h5py
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+
+import constants
+import process_data
+import picking
+import plot
+import profiling
+import signal_processing
+import storage
+import uncertainty
+
+
+def make_synthetic_stations(path, n_stations, n_samples, delta=0.1,
+                            celerity=310, seed=0):
+    """Write synthetic raw station files, in the layout process_data expects.
+
+    Every file has a waveform in waveforms/<name> with the attributes
+    'starttime' and 'delta', and the attributes 'latitude' and 'longitude'
+    on the file itself. The waveforms are white noise, with a burst of louder
+    noise arriving from Hunga Tonga at the given celerity.
+
+    Arguments:
+        path: Directory to write the files to.
+        n_stations: Number of stations.
+        n_samples: Number of samples in the longest waveform. The waveforms
+                   are up to 1% shorter, like in the real data.
+        delta: Time between samples in seconds. 0.1 by default.
+        celerity: Speed of the burst in m/s. 310 by default.
+        seed: Seed of the random number generator. 0 by default.
+    """
+    os.makedirs(path, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    # An hour before the eruption
+    starttime = datetime.datetime(2022, 1, 15, 3, 14)
+    eruption = process_data.unix_time(datetime.datetime(2022, 1, 15, 4, 14))
+
+    for i in range(n_stations):
+        name = f"SY.S{i:04}"
+        lat, lon = rng.uniform(-80, 80), rng.uniform(-180, 180)
+        length = n_samples - int(rng.integers(0, n_samples//100 + 1))
+        waveform = rng.standard_normal(length)
+
+        arrival = eruption + process_data.distance(constants.TONGA_COORDINATES,
+                                                   (lat, lon))/celerity
+        first = int((arrival - process_data.unix_time(starttime))/delta)
+        waveform[max(0, first):max(0, first + int(1800/delta))] *= 8
+
+        with h5py.File(os.path.join(path, f"{name}.h5"), "w") as file:
+            file.attrs["latitude"] = lat
+            file.attrs["longitude"] = lon
+            dataset = file.create_dataset(f"waveforms/{name}", data=waveform)
+            dataset.attrs["starttime"] = starttime.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+            dataset.attrs["delta"] = delta
+
+
+def measure(function, *args, setup=None, **kwargs):
+    """Time a function, and measure the memory it uses.
+
+    The function is run twice: once to time it, and once with tracemalloc on
+    to measure its memory, since tracing every allocation slows down Python
+    heavy code several times.
+
+    Arguments:
+        function: Function to call.
+        *args, **kwargs: Arguments to call it with.
+        setup: Function called without arguments before both runs, e.g. to
+               remove the outputs cached by the first one. None by default.
+
+    Return:
+        Dictionary with the wall and CPU time in seconds, the peak memory
+        allocated through Python (including numpy arrays) in bytes, and the
+        peak resident set size of the process so far in bytes. The memory is
+        only that of this process, so it leaves out the processes started by
+        the function, like the ingestion workers when workers is above 1.
+    """
+    if setup is not None:
+        setup()
+    wall, cpu = time.perf_counter(), time.process_time()
+    function(*args, **kwargs)
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    function(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"wall_seconds": wall, "cpu_seconds": cpu,
+            "peak_traced_bytes": peak, "max_rss_bytes": profiling.max_rss()}
+
+
+# Commands whose startup time is measured, run from the source directory. They
+# cover --help, and the imports done by every compute-only action and plot
+STARTUP_COMMANDS = {
+    "startup_help": ["main.py", "--help"],
+    "startup_import_main": ["-c", "import main"],
+    "startup_import_process_data": ["-c", "import process_data"],
+    "startup_import_plot": ["-c", "import plot"],
+}
+
+
+def measure_startup(command, repeats=5):
+    """Measure how long a fresh Python process takes to run a command, and
+    how much of it is spent importing modules, using python -X importtime.
+
+    Arguments:
+        command: List of arguments given to the Python interpreter.
+        repeats: Number of times the command is run. 5 by default.
+
+    Return:
+        Dictionary with the median wall time and import time in seconds.
+    """
+    walls, imports = [], []
+    for _ in range(repeats):
+        wall = time.perf_counter()
+        result = subprocess.run([sys.executable, "-X", "importtime"] + command,
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True)
+        walls.append(time.perf_counter() - wall)
+
+        # Lines look like 'import time: self | cumulative | name', with the
+        # names of nested imports indented
+        import_us = 0
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:"):
+                continue
+            _, cumulative, name = line.split("|")
+            if cumulative.strip().isdigit() and not name.startswith("  "):
+                import_us += int(cumulative)
+        imports.append(import_us/1e6)
+
+    return {"wall_seconds": float(np.median(walls)),
+            "import_seconds": float(np.median(imports))}
+
+
+def run_startup_benchmarks():
+    """Measure the startup time of all STARTUP_COMMANDS.
+
+    Return:
+        Dictionary with the measurements of every command.
+    """
+    return {name: measure_startup(command)
+            for name, command in STARTUP_COMMANDS.items()}
+
+
+def run_benchmarks(n_stations, n_samples, workers=1):
+    """Run every stage of the pipeline on synthetic data, and measure them.
+
+    Arguments:
+        n_stations: Number of synthetic stations.
+        n_samples: Number of samples in every synthetic waveform.
+        workers: Number of processes used for ingestion. 1 by default.
+
+    Return:
+        Dictionary with the measurements of every stage.
+    """
+    h_list = [constants.h1, constants.h2, constants.h3]
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        raw_dir = os.path.join(tmp_dir, "raw")
+        processed_dir = os.path.join(tmp_dir, "stations")
+        filtered_dir = os.path.join(tmp_dir, "filtered")
+        make_synthetic_stations(raw_dir, n_stations, n_samples)
+
+        # The stores are removed before every run, so nothing is reused from
+        # the cache of the run before
+        results["ingest"] = measure(process_data.process_data, workers=workers,
+                                    raw_dir=raw_dir, processed_dir=processed_dir,
+                                    n_samples=n_samples,
+                                    setup=lambda: shutil.rmtree(processed_dir,
+                                                                ignore_errors=True))
+        results["filter_signals"] = measure(process_data.filter_signals, h_list,
+                                            processed_dir, filtered_dir,
+                                            setup=lambda: shutil.rmtree(filtered_dir,
+                                                                        ignore_errors=True))
+
+        processed = storage.ProcessedStore(processed_dir)
+        filtered = storage.FilteredStore(filtered_dir)
+        results["dtft"] = measure(lambda: [signal_processing.dtft(x)
+                                           for x in processed["data"]])
+
+        def sections():
+            pyramid = storage.LodPyramid.open_or_build(filtered)
+            sort_inds = np.argsort(processed["distances"])
+            signals = [pyramid.envelope(1, i, n_points=2000) for i in sort_inds]
+            plot.sections(signals, processed.times[sort_inds],
+                          processed["distances"][sort_inds],
+                          os.path.join(tmp_dir, "sections.pdf"))
+        results["plot_sections"] = measure(
+            sections, setup=lambda: shutil.rmtree(os.path.join(filtered_dir, "lod"),
+                                                  ignore_errors=True)
+        )
+
+        def arrival_times():
+            arrival_times, confidences = picking.pick_arrival_times(
+                filtered[1], processed.times, min_time=constants.TONGA_ARRIVALS_START
+            )
+            np.polynomial.polynomial.Polynomial.fit(
+                arrival_times, processed["distances"]/1000, deg=1, w=confidences
+            )
+        results["arrival_times"] = measure(arrival_times)
+
+        arrival_times, confidences = picking.pick_arrival_times(
+            filtered[1], processed.times, min_time=constants.TONGA_ARRIVALS_START
+        )
+        results["fit_uncertainty"] = measure(uncertainty.line_fit_uncertainty,
+                                             arrival_times, processed["distances"]/1000,
+                                             confidences)
+
+    return results
+
+
+def git_version():
+    """Get the current commit of the repository, or None if it is unknown.
+    """
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"],
+                              cwd=constants.ROOT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_filename, new_filename):
+    """Print how much every measurement changed between two benchmark runs.
+
+    Arguments:
+        old_filename: Path to the JSON results of the old run.
+        new_filename: Path to the JSON results of the new run.
+    """
+    with open(old_filename) as file:
+        old = json.load(file)
+    with open(new_filename) as file:
+        new = json.load(file)
+
+    print(f"{old['version']} -> {new['version']}")
+    for stage, measurements in new["results"].items():
+        for name, value in measurements.items():
+            old_value = old["results"].get(stage, {}).get(name)
+            if old_value:
+                print(f"{stage:>16} {name:>18}: {old_value:12.4g} -> "\
+                      f"{value:12.4g} ({value/old_value:.2f}x)")
+
+
+def parse_arguments(argv=None):
+    """Parse all the arguments given to the module.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--stations", type=int, default=20,
+                        help="Number of synthetic stations. 20 by default.")
+    parser.add_argument("--samples", type=int, default=process_data.N_SAMPLES,
+                        help="Number of samples in every synthetic waveform. "\
+                             f"{process_data.N_SAMPLES} by default.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes used for ingestion. 1 by "\
+                             "default.")
+    parser.add_argument("--output", default=None,
+                        help="Path to save the results to as JSON. They are "\
+                             "only printed by default.")
+    parser.add_argument("--startup", action="store_true",
+                        help="Only measure the startup time of main.py and "\
+                             "the imports of its actions.")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="Compare the results of two earlier runs instead.")
+
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_arguments()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = {"version": git_version(),
+               "date": datetime.datetime.now().isoformat(),
+               "platform": platform.platform(),
+               "cpu_count": os.cpu_count(),
+               "parameters": {"stations": args.stations, "samples": args.samples,
+                              "workers": args.workers},
+               "results": run_startup_benchmarks()}
+    if not args.startup:
+        results["results"].update(run_benchmarks(args.stations, args.samples,
+                                                 args.workers))
+
+    print(json.dumps(results, indent=4))
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Content addressed keys for the pipeline, so only stations whose inputs
+changed are processed again.
+"""
+import hashlib
+import json
+
+import numpy as np
+
+
+def file_digest(filename, chunk_size=1 << 20):
+    """Get the SHA-256 hex digest of the contents of a file.
+
+    Arguments:
+        filename: Path to the file.
+        chunk_size: Number of bytes read at once. 1 MiB by default.
+
+    Return:
+        String with 64 hexadecimal digits.
+    """
+    sha = hashlib.sha256()
+    with open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def digest(*parts, **params):
+    """Get the SHA-256 hex digest of some strings and parameters.
+
+    Arguments:
+        *parts: Strings, e.g. other digests.
+        **params: Named parameters. Arrays and tuples are converted to lists,
+                  so everything has to be serializable as JSON.
+
+    Return:
+        String with 64 hexadecimal digits.
+    """
+    def serializable(value):
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        if isinstance(value, (list, tuple)):
+            return [serializable(v) for v in value]
+        return value
+
+    sha = hashlib.sha256()
+    for part in parts:
+        sha.update(part.encode())
+    params = {name: serializable(value) for name, value in params.items()}
+    sha.update(json.dumps(params, sort_keys=True).encode())
+    return sha.hexdigest()
+
+
+class CacheStats:
+    """Counts of cache hits and misses for every stage of the pipeline.
+    """
+    def __init__(self):
+        self.counts = {}
+
+    def _add(self, stage, kind, n):
+        self.counts.setdefault(stage, {"hits": 0, "misses": 0})[kind] += n
+
+    def hit(self, stage, n=1):
+        self._add(stage, "hits", n)
+
+    def miss(self, stage, n=1):
+        self._add(stage, "misses", n)
+
+    def merge(self, counts):
+        """Add the counts of another CacheStats, e.g. from another process.
+        """
+        for stage, stage_counts in counts.items():
+            for kind, n in stage_counts.items():
+                self._add(stage, kind, n)
+
+    def report(self):
+        """Get a summary of the hits and misses, one line for every stage.
+        """
+        return "\n".join(f"Cache {stage}: {counts['hits']} hits, "\
+                         f"{counts['misses']} misses"
+                         for stage, counts in self.counts.items())
+
+
+# Statistics for this run of the pipeline
+stats = CacheStats()
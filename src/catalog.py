@@ -0,0 +1,162 @@
+"""Events the pipeline can process, each with its own source, time window, raw
+data and outputs.
+
+A catalog is a JSON file with a list of events, like
+    [
+        {"name": "hunga_tonga", "latitude": -20.550, "longitude": -175.385,
+         "start_time": "2022-01-15T03:00:00Z", "end_time": "2022-01-15T23:00:00Z",
+         "raw_dir": "raw/hunga_tonga"}
+    ]
+where "end_time", "arrivals_start", "output_dir" and "n_samples" are optional,
+see Event. Times are given as UTC in this format or in seconds since the UNIX
+epoch, and relative directories are relative to the catalog file.
+"""
+import os
+import json
+from datetime import datetime
+
+import constants
+
+
+class Event:
+    """One source of waves, with where to read its raw data and save its
+    outputs.
+
+    Arguments:
+        name: Name of the event, used for its output directory.
+        coordinates: Tuple with the latitude and longitude of the source.
+        raw_dir: Directory with the raw HDF5 files of the stations.
+        output_dir: Directory to save the processed data, arrival times and
+                    plots in. None by default, meaning the directories in
+                    constants, data/processed, data/arrival_times and plots.
+        start_time: Samples before this are dropped when reading the raw
+                    data, in seconds since the UNIX epoch. None by default,
+                    meaning none are dropped.
+        end_time: Samples after this are dropped, like start_time.
+        arrivals_start: Arrival times before this are not from the event, in
+                        seconds since the UNIX epoch. None by default, meaning
+                        start_time, or 0 if that isn't given either.
+        n_samples: Length every waveform is padded or cut to. None by default,
+                   meaning process_data.N_SAMPLES.
+    """
+    def __init__(self, name, coordinates, raw_dir, output_dir=None,
+                 start_time=None, end_time=None, arrivals_start=None,
+                 n_samples=None):
+        self.name = name
+        self.coordinates = tuple(coordinates)
+        self.raw_dir = raw_dir
+        self.output_dir = output_dir
+        self.start_time = start_time
+        self.end_time = end_time
+        if arrivals_start is None:
+            arrivals_start = 0 if start_time is None else start_time
+        self.arrivals_start = arrivals_start
+        self.n_samples = n_samples
+
+    def __repr__(self):
+        return f"Event({self.name!r}, {self.coordinates})"
+
+    def _path(self, default, *parts):
+        return default if self.output_dir is None else os.path.join(self.output_dir, *parts)
+
+    @property
+    def processed_dir(self):
+        return self._path(constants.PROCESSED_DIR, "processed", "stations")
+
+    @property
+    def filtered_dir(self):
+        return self._path(constants.FILTERED_DIR, "processed", "filtered")
+
+    @property
+    def correlations_dir(self):
+        return self._path(constants.CORRELATIONS_DIR, "processed", "correlations")
+
+    @property
+    def spectra_dir(self):
+        return self._path(constants.SPECTRA_DIR, "processed", "spectra")
+
+    @property
+    def streamed_filename(self):
+        return self._path(os.path.join(constants.ROOT_DIR, "data", "processed",
+                                       "streamed.npy"),
+                          "processed", "streamed.npy")
+
+    @property
+    def arrival_times_filename(self):
+        return self._path(constants.ARRIVAL_TIMES_FILENAME, "arrival_times",
+                          "arrival_times.npy")
+
+    @property
+    def refined_arrival_times_filename(self):
+        return self._path(constants.REFINED_ARRIVAL_TIMES_FILENAME, "arrival_times",
+                          "refined_arrival_times.npy")
+
+    @property
+    def valids_filename(self):
+        return self._path(constants.VALIDS_FILENAME, "arrival_times", "valids.npy")
+
+    @property
+    def source_filename(self):
+        return self._path(constants.SOURCE_FILENAME, "arrival_times", "source.npz")
+
+    @property
+    def plots_dir(self):
+        return self._path(constants.PLOTS_DIR, "plots")
+
+    def make_dirs(self):
+        """Make the output directories of the event, if it has its own.
+        """
+        if self.output_dir is not None:
+            for path in (os.path.join(self.output_dir, "processed"),
+                         os.path.dirname(self.arrival_times_filename),
+                         self.plots_dir):
+                os.makedirs(path, exist_ok=True)
+
+
+# The event the project is about, with the original layout of the repository
+HUNGA_TONGA = Event("hunga_tonga", constants.TONGA_COORDINATES,
+                    os.path.join(constants.ROOT_DIR, "data", "raw"),
+                    arrivals_start=constants.TONGA_ARRIVALS_START)
+
+
+def parse_time(value):
+    """Get a time given as UTC like '2022-01-15T03:00:00Z', or as seconds
+    since the UNIX epoch, in seconds since the UNIX epoch. None is kept.
+    """
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return (datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ")
+            - datetime(1970, 1, 1)).total_seconds()
+
+
+def load_catalog(filename):
+    """Read the events of a catalog file.
+
+    Arguments:
+        filename: Path to the JSON catalog, see the module documentation.
+
+    Return:
+        List of Event. Events without an output_dir get the directory with
+        their name in data/events.
+    """
+    with open(filename) as file:
+        entries = json.load(file)
+
+    base_dir = os.path.dirname(os.path.abspath(filename))
+    events = []
+    for entry in entries:
+        output_dir = entry.get("output_dir",
+                               os.path.join(constants.ROOT_DIR, "data", "events",
+                                            entry["name"]))
+        events.append(Event(entry["name"], (entry["latitude"], entry["longitude"]),
+                            os.path.join(base_dir, entry["raw_dir"]),
+                            os.path.join(base_dir, output_dir),
+                            start_time=parse_time(entry.get("start_time")),
+                            end_time=parse_time(entry.get("end_time")),
+                            arrivals_start=parse_time(entry.get("arrivals_start")),
+                            n_samples=entry.get("n_samples")))
+
+    names = [event.name for event in events]
+    if len(set(names)) != len(names):
+        raise ValueError(f"The events in {filename} must have unique names.")
+    return events
@@ -3,10 +3,22 @@ import os
 import numpy as np
 
 TONGA_COORDINATES = (-20.550, -175.385)
+# Arrival times before this are not from the eruption, in seconds since the UNIX epoch
+TONGA_ARRIVALS_START = 1.642218e09
 
 h1 = np.array([9.3102e-04, -1.2991e-18, -1.1771e-03, -8.9350e-04, 1.1279e-03, 2.3259e-03, -3.0497e-18, -3.7419e-03, -2.8954e-03, 3.5886e-03, 7.1273e-03, -6.7002e-18, -1.0473e-02, -7.7679e-03, 9.2793e-03, 1.7882e-02, -1.0958e-17, -2.5342e-02, -1.8731e-02, 2.2575e-02, 4.4596e-02, -1.4316e-17, -7.1659e-02, -6.0472e-02, 9.2253e-02, 3.0157e-01, 3.9980e-01, 3.0157e-01, 9.2253e-02, -6.0472e-02, -7.1659e-02, -1.4316e-17, 4.4596e-02, 2.2575e-02, -1.8731e-02, -2.5342e-02, -1.0958e-17, 1.7882e-02, 9.2793e-03, -7.7679e-03, -1.0473e-02, -6.7002e-18, 7.1273e-03, 3.5886e-03, -2.8954e-03, -3.7419e-03, -3.0497e-18, 2.3259e-03, 1.1279e-03, -8.9350e-04, -1.1771e-03, -1.2991e-18, 9.3102e-04])
 h2 = np.array([6.8867e-04, -1.0409e-18, -8.7071e-04, -1.6144e-04, 2.4454e-03, 4.3979e-03, 2.9653e-03, 1.8510e-04, 1.9464e-03, 9.1274e-03, 1.2922e-02, 5.3683e-03, -6.4293e-03, -6.1213e-03, 7.3124e-03, 1.0978e-02, -1.3170e-02, -4.5946e-02, -4.7642e-02, -1.5176e-02, -2.2060e-03, -5.5677e-02, -1.3549e-01, -1.3111e-01, 1.6668e-02, 2.2307e-01, 3.2035e-01, 2.2307e-01, 1.6668e-02, -1.3111e-01, -1.3549e-01, -5.5677e-02, -2.2060e-03, -1.5176e-02, -4.7642e-02, -4.5946e-02, -1.3170e-02, 1.0978e-02, 7.3124e-03, -6.1213e-03, -6.4293e-03, 5.3683e-03, 1.2922e-02, 9.1274e-03, 1.9464e-03, 1.8510e-04, 2.9653e-03, 4.3979e-03, 2.4454e-03, -1.6144e-04, -8.7071e-04, -1.0409e-18, 6.8867e-04])
 h3 = np.array([-2.4366e-04, -2.6135e-19, 3.0807e-04, 7.3294e-04, 1.3147e-03, 2.0667e-03, 2.9630e-03, 3.9300e-03, 4.8428e-03, 5.5289e-03, 5.7792e-03, 5.3643e-03, 4.0571e-03, 1.6578e-03, -1.9803e-03, -6.9275e-03, -1.3160e-02, -2.0549e-02, -2.8859e-02, -3.7759e-02, -4.6838e-02, -5.5636e-02, -6.3672e-02, -7.0487e-02, -7.5676e-02, -7.8923e-02, 9.2033e-01, -7.8923e-02, -7.5676e-02, -7.0487e-02, -6.3672e-02, -5.5636e-02, -4.6838e-02, -3.7759e-02, -2.8859e-02, -2.0549e-02, -1.3160e-02, -6.9275e-03, -1.9803e-03, 1.6578e-03, 4.0571e-03, 5.3643e-03, 5.7792e-03, 5.5289e-03, 4.8428e-03, 3.9300e-03, 2.9630e-03, 2.0667e-03, 1.3147e-03, 7.3294e-04, 3.0807e-04, -2.6135e-19, -2.4366e-04])
 
 ROOT_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
-PLOTS_DIR = os.path.join(ROOT_DIR, "plots")
\ No newline at end of file
+PLOTS_DIR = os.path.join(ROOT_DIR, "plots")
+PROCESSED_DIR = os.path.join(ROOT_DIR, "data", "processed", "stations")
+FILTERED_DIR = os.path.join(ROOT_DIR, "data", "processed", "filtered")
+CORRELATIONS_DIR = os.path.join(ROOT_DIR, "data", "processed", "correlations")
+SPECTRA_DIR = os.path.join(ROOT_DIR, "data", "processed", "spectra")
+BASEMAP_DIR = os.path.join(ROOT_DIR, "data", "processed", "basemaps")
+ARRIVAL_TIMES_FILENAME = os.path.join(ROOT_DIR, "data", "arrival_times", "arrival_times.npy")
+REFINED_ARRIVAL_TIMES_FILENAME = os.path.join(ROOT_DIR, "data", "arrival_times",
+                                              "refined_arrival_times.npy")
+VALIDS_FILENAME = os.path.join(ROOT_DIR, "data", "arrival_times", "valids.npy")
+SOURCE_FILENAME = os.path.join(ROOT_DIR, "data", "arrival_times", "source.npz")
@@ -0,0 +1,200 @@
+"""Location of the source of the wave from the arrival times at the stations.
+
+The wave is assumed to travel along great circles at a constant celerity, so
+the arrival time at a station is t0 + d/c, where t0 is the origin time, d the
+distance from the source and c the celerity. Candidate sources on a grid of
+latitudes and longitudes are tested against all arrival times at once, and
+the grid is refined around the best one.
+"""
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import haversine as hs
+
+import profiling
+
+
+def distance_matrix(node_lats, node_lons, lats, lons):
+    """Get the great circle distances between grid nodes and stations.
+
+    Arguments:
+        node_lats: 1-d array with the latitudes of the nodes in degrees.
+        node_lons: 1-d array with the longitudes of the nodes in degrees.
+        lats: 1-d array with the latitudes of the stations in degrees.
+        lons: 1-d array with the longitudes of the stations in degrees.
+
+    Return:
+        2-d array with the distance in meters between every node and station,
+        indexed by (node, station).
+    """
+    return hs.haversine_vector(np.stack((lats, lons), axis=1),
+                               np.stack((node_lats, node_lons), axis=1),
+                               hs.Unit.METERS, comb=True)
+
+
+def misfit(distances, arrival_times, weights, celerities):
+    """Get the misfit of the arrival times for candidate sources and
+    celerities, with the best origin time for each.
+
+    For a given source and celerity the origin time minimizing the weighted
+    squared residuals is the weighted mean of t - d/c, so the misfit only
+    depends on the weighted means and (co)variances of the arrival times and
+    distances. These are computed with one matrix product for all nodes, and
+    combined for every celerity without forming the residuals.
+
+    Arguments:
+        distances: 2-d array with the distances between every node and
+                   station, like the output of distance_matrix.
+        arrival_times: 1-d array with the arrival time at every station.
+        weights: 1-d array with the weight of every arrival time. Must sum to
+                 more than 0.
+        celerities: 1-d array with the celerities to test, in m/s.
+
+    Return:
+        Two arrays indexed by (node, celerity), with the weighted root mean
+        square residual in seconds, and the best origin time.
+    """
+    weights = weights/np.sum(weights)
+    # Subtracting the mean time keeps the variances accurate for UNIX times
+    mean_time = np.sum(weights*arrival_times)
+    times = arrival_times - mean_time
+
+    mean_distance = distances @ weights
+    var_time = np.sum(weights*times**2)
+    cov = distances @ (weights*times) - mean_distance*np.sum(weights*times)
+    var_distance = (distances**2) @ weights - mean_distance**2
+
+    slowness = 1/np.asarray(celerities, dtype=float)[np.newaxis, :]
+    mean_squares = var_time - 2*slowness*cov[:, np.newaxis] \
+                   + slowness**2*var_distance[:, np.newaxis]
+    origin_times = mean_time - slowness*mean_distance[:, np.newaxis]
+    return np.sqrt(np.maximum(mean_squares, 0)), origin_times
+
+
+# Stations used by the worker processes, set by _init_worker
+_stations = None
+
+def _init_worker(lats, lons, arrival_times, weights):
+    global _stations
+    _stations = (lats, lons, arrival_times, weights)
+
+
+def _evaluate_nodes(task):
+    node_lats, node_lons, celerities = task
+    lats, lons, arrival_times, weights = _stations
+    distances = distance_matrix(node_lats, node_lons, lats, lons)
+    return misfit(distances, arrival_times, weights, celerities)
+
+
+def grid_search(node_lats, node_lons, celerities, lats, lons, arrival_times,
+                weights, workers=1, chunk_size=4096):
+    """Evaluate the misfit of every node of a grid, see misfit.
+
+    The nodes are split into chunks, so the distance matrix of only one chunk
+    is held in memory by every process at a time.
+
+    Arguments:
+        node_lats: 1-d array with the latitudes of the nodes in degrees.
+        node_lons: 1-d array with the longitudes of the nodes in degrees.
+        celerities: 1-d array with the celerities to test, in m/s.
+        lats: 1-d array with the latitudes of the stations in degrees.
+        lons: 1-d array with the longitudes of the stations in degrees.
+        arrival_times: 1-d array with the arrival time at every station.
+        weights: 1-d array with the weight of every arrival time.
+        workers: Number of processes evaluating chunks in parallel. 1 by
+                 default, meaning everything is done in this process.
+        chunk_size: Number of nodes in every chunk. 4096 by default.
+
+    Return:
+        Two arrays indexed by (node, celerity), with the misfit and the best
+        origin time.
+    """
+    station_args = (lats, lons, arrival_times, weights)
+    tasks = [(node_lats[start:start + chunk_size], node_lons[start:start + chunk_size],
+              celerities) for start in range(0, len(node_lats), chunk_size)]
+
+    if workers == 1:
+        _init_worker(*station_args)
+        results = [_evaluate_nodes(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=station_args) as executor:
+            results = list(executor.map(_evaluate_nodes, tasks))
+
+    return (np.concatenate([result[0] for result in results]),
+            np.concatenate([result[1] for result in results]))
+
+
+def locate(lats, lons, arrival_times, weights, step=2.0, celerities=None,
+           levels=3, shrink=8, workers=1):
+    """Find the source, origin time and celerity best explaining the arrival
+    times, with a coarse to fine grid search.
+
+    The first level covers the whole globe with nodes step degrees apart.
+    Every following level covers the neighbourhood of the best node of the
+    level before, and the celerities around the best one, with nodes shrink
+    times closer.
+
+    Arguments:
+        lats: 1-d array with the latitudes of the stations in degrees.
+        lons: 1-d array with the longitudes of the stations in degrees.
+        arrival_times: 1-d array with the arrival time at every station, in
+                       seconds since the UNIX epoch.
+        weights: 1-d array with the weight of every arrival time, e.g. from
+                 picking.validness_to_weights. Stations with weight 0 are
+                 ignored.
+        step: Distance between the nodes of the first level in degrees. 2 by
+              default.
+        celerities: 1-d array with the celerities of the first level in m/s.
+                    None by default, meaning 200 to 400 m/s in steps of 2 m/s.
+        levels: Number of levels. 3 by default.
+        shrink: Factor the distance between nodes shrinks by for every
+                level. 8 by default.
+        workers: Number of processes used, see grid_search. 1 by default.
+
+    Return:
+        Dictionary with the latitude, longitude, origin time, celerity and
+        misfit of the best source, and a tuple with the latitudes and
+        longitudes of the first level, and the misfit at every node of it
+        for its best celerity, indexed by (latitude, longitude).
+    """
+    used = np.asarray(weights) > 0
+    stations = (np.asarray(lats)[used], np.asarray(lons)[used],
+                np.asarray(arrival_times, dtype=float)[used],
+                np.asarray(weights, dtype=float)[used])
+    if celerities is None:
+        celerities = np.arange(200, 401, 2, dtype=float)
+    celerity_step = celerities[1] - celerities[0] if len(celerities) > 1 else 0
+
+    grid_lats = np.arange(-90, 90 + step/2, step)
+    grid_lons = np.arange(-180, 180, step)
+    surface = None
+
+    for level in range(levels):
+        with profiling.stage("grid_search"):
+            node_lats, node_lons = (a.ravel() for a in
+                                    np.meshgrid(grid_lats, grid_lons, indexing="ij"))
+            misfits, origin_times = grid_search(node_lats, node_lons, celerities,
+                                                *stations, workers=workers)
+        node, c = np.unravel_index(np.argmin(misfits), misfits.shape)
+        best = {"latitude": float(node_lats[node]),
+                "longitude": float(node_lons[node]),
+                "origin_time": float(origin_times[node, c]),
+                "celerity": float(celerities[c]),
+                "misfit": float(misfits[node, c])}
+        if surface is None:
+            surface = (grid_lats, grid_lons,
+                       misfits.min(axis=1).reshape(len(grid_lats), len(grid_lons)))
+
+        # The next level covers the nodes next to the best one, more densely
+        offsets = np.arange(-shrink, shrink + 1)*step/shrink
+        grid_lats = np.clip(best["latitude"] + offsets, -90, 90)
+        grid_lons = (best["longitude"] + offsets + 180) % 360 - 180
+        step /= shrink
+        if celerity_step:
+            celerities = np.maximum(best["celerity"]
+                                    + np.arange(-shrink, shrink + 1)*celerity_step/shrink,
+                                    celerity_step/shrink)
+            celerity_step /= shrink
+
+    return best, surface
@@ -1,13 +1,21 @@
 import os
 import sys
 import argparse
+import datetime
+import resource
+from collections import deque
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor, wait,
+                                as_completed, FIRST_COMPLETED)
 
 import numpy as np
 
+import cache
+import catalog
 import constants
-import process_data
-import plot
-import signal_processing
+import profiling
+# The other modules, and their dependencies like matplotlib, cartopy and
+# scipy, are imported by the actions using them, so e.g. --help or
+# --filter-signals don't spend time importing what they never use
 
 
 def parse_arguments(argv=None):
@@ -33,134 +41,668 @@ def parse_arguments(argv=None):
     parser.add_argument("--plot-freq-spec", action="store_true",
                         help="Plot the absolute values of the frequency "\
                              "spectrums from h1, h2 and h3.")
+    parser.add_argument("--quality-control", action="store_true",
+                        help="Compute the power spectra of all the signals, "\
+                             "and flag dead, noisy and gappy stations, which "\
+                             "are then left out of filtering and picking.")
     parser.add_argument("--filter-signals", action="store_true",
                         help="Filter all 201 signals from the different "\
                              "stations with h1, h2 and h3.")
     parser.add_argument("--plot-sections", action="store_true",
                         help="Plot all the signals from the different stations,"\
                              " filtered through h3.")
+    parser.add_argument("--pick-arrival-times", action="store_true",
+                        help="Automatically pick the arrival times of the wave "\
+                             "at all the different stations, with a confidence "\
+                             "for each pick.")
     parser.add_argument("--mark-arrival-times", action="store_true",
                         help="Mark the arrival times of the wave at all the "\
                              "different stations.")
+    parser.add_argument("--refine-arrival-times", action="store_true",
+                        help="Refine the arrival times of the wave by "\
+                             "cross-correlating the filtered signals of "\
+                             "neighbouring stations around them.")
     parser.add_argument("--plot-arrival-times", action="store_true",
                         help="Plot the arrival times of the wave at all the "\
                              "different stations against their distances.")
-    
+    parser.add_argument("--locate-source", action="store_true",
+                        help="Locate the source of the wave from the arrival "\
+                             "times at all the different stations, and plot "\
+                             "the misfit of every candidate source.")
+    parser.add_argument("--stream", metavar="SOURCE", default=None,
+                        help="Filter and pick arrival times from waveform "\
+                             "chunks as they arrive, either as .npy files in "\
+                             "the directory SOURCE or over a socket at "\
+                             "SOURCE=host:port.")
+    parser.add_argument("--decimate", type=int, default=1,
+                        help="Decimate the filtered signals by this factor "\
+                             "with --filter-signals, using an anti-aliasing "\
+                             "polyphase filter. 1 by default, meaning no "\
+                             "decimation.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes used to read the raw files "\
+                             "with --parse-data, and to search for the source "\
+                             "with --locate-source. 1 by default.")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of processes running the requested "\
+                             "actions. With more than 1, actions that don't "\
+                             "depend on each other, like the plots, are run "\
+                             "at the same time. 1 by default.")
+    parser.add_argument("--catalog", metavar="FILENAME", default=None,
+                        help="Run the requested actions for every event in the"\
+                             " JSON catalog FILENAME, each with its own source,"\
+                             " time window, raw data and outputs, instead of "\
+                             "for Hunga Tonga. See src/catalog.py for the "\
+                             "format.")
+    parser.add_argument("--event-workers", type=int, default=1,
+                        help="Number of events processed at the same time with"\
+                             " --catalog, each in its own process. 1 by "\
+                             "default.")
+    parser.add_argument("--memory-limit", type=float, metavar="MB", default=None,
+                        help="With --catalog, the most memory all the events "\
+                             "processed at the same time may use together, in"\
+                             " MB. Split evenly between every process they "\
+                             "may start, including those of --jobs and "\
+                             "--workers, and an event going over its share "\
+                             "fails. No limit by default.")
+    parser.add_argument("--float32", action="store_true",
+                        help="Store the processed waveforms as 32-bit floats "\
+                             "with --parse-data, halving their size.")
+    parser.add_argument("--profile", metavar="FILENAME",
+                        default=os.environ.get("IN3190_PROFILE"),
+                        help="Record the time, memory and I/O of every action "\
+                             "and its main steps, and save it as a Chrome "\
+                             "trace. Also set by the IN3190_PROFILE "\
+                             "environment variable.")
+    parser.add_argument("--cprofile", metavar="STAGE",
+                        default=os.environ.get("IN3190_CPROFILE"),
+                        help="With --profile, also run cProfile on the stage "\
+                             "STAGE, e.g. filter_signals or render, saving it "\
+                             "as FILENAME.STAGE.prof. Also set by the "\
+                             "IN3190_CPROFILE environment variable.")
+    parser.add_argument("--review-below", type=float, default=None,
+                        help="With --mark-arrival-times, also mark the stations"\
+                             " whose arrival time has a confidence below this.")
+    parser.add_argument("--resamples", type=int, default=2000,
+                        help="Number of bootstrap resamples of the stations "\
+                             "used for the uncertainty of the fit with "\
+                             "--plot-arrival-times. 2000 by default.")
 
     return parser.parse_args(argv)
 
 
-def main():
-    processed_data_filename = os.path.join(constants.ROOT_DIR, "data",
-                                           "processed", "processed.npz")
-    convolved_dir = os.path.join(constants.ROOT_DIR, "data", "processed",
-                                     "convolved")
-    arrival_times_filename = os.path.join(constants.ROOT_DIR, "data",
-                                          "arrival_times", "arrival_times.npy")
-    valids_filename = os.path.join(constants.ROOT_DIR, "data",
-                                   "arrival_times", "valids.npy")
+H_LIST = [constants.h1, constants.h2, constants.h3]
 
-    h_list = [constants.h1, constants.h2, constants.h3]
 
-    args = parse_arguments()
-    
-    if args.parse_data:
-        process_data.process_data()
-    
-    if args.plot_map:
-        processed_data = np.load(processed_data_filename)
-        lats, lons = processed_data["lats"], processed_data["lons"]
-        stations_coordinates = np.concatenate((lats[:, np.newaxis],
-                                               lons[:, np.newaxis]),
-                                              axis=1)
-        plot.geography(constants.TONGA_COORDINATES, stations_coordinates, 
-                       os.path.join(constants.PLOTS_DIR, "map.pdf"))
-    
-    if args.plot_distances:
-        processed_data = np.load(processed_data_filename)
-        distances = processed_data["distances"]
-        plot.distances(distances,
-                       os.path.join(constants.PLOTS_DIR, "distances.pdf"))
-    
-    if args.plot_fir:
-        plot.input_response(h_list,
-                            ["$h_1$", "$h_2$", "$h_3$"],
-                            os.path.join(constants.PLOTS_DIR, "fir.pdf"))
-    
-    if args.plot_freq_spec:
-        plot.frequency_spectrum(h_list,
-                                ["$H_1$ - lowpass", "$H_2$ - bandpass", "$H_3$ - highpass"],
-                                side_by_side=True,
-                                filename=os.path.join(constants.PLOTS_DIR, "freq_spec.pdf"))
-    
-    if args.filter_signals:
-        convolved_dir = os.path.join(constants.ROOT_DIR, "data", "processed",
-                                     "convolved")
-        processed_data = np.load(processed_data_filename)
-        for i, x in enumerate(processed_data["data"]):
-            for j, h in enumerate(h_list):
-                y = signal_processing.convolution(x, h, ylen_choice=False)
-                filename = os.path.join(convolved_dir, f"h{j+1}_x{i:03}.npy")
-                np.save(filename, y)
+# Stores opened by the actions run in this process, with the modification
+# time of the file marking them as complete when they were opened
+_stores = {}
+
+def _shared_store(cls, path, complete_filename):
+    try:
+        stamp = os.stat(os.path.join(path, complete_filename)).st_mtime_ns
+    except FileNotFoundError:
+        stamp = None
+    key = (cls, path)
+    if key not in _stores or _stores[key][1] != stamp or stamp is None:
+        _stores[key] = (cls(path), stamp)
+    return _stores[key][0]
+
+
+def processed_store(event):
+    """Get the processed data store of an event, shared between actions so the
+    fields they read are only loaded once, until --parse-data writes it again.
+    """
+    import storage
+    return _shared_store(storage.ProcessedStore, event.processed_dir, "keys.npy")
+
+
+def filtered_store(event):
+    """Get the filtered data store of an event, shared between actions like
+    processed_store.
+    """
+    import storage
+    return _shared_store(storage.FilteredStore, event.filtered_dir, "header.json")
+
+
+def parse_data(args, event):
+    """Load the raw data, and save it in the processed data store.
+    """
+    import process_data
+    process_data.process_data(workers=args.workers, raw_dir=event.raw_dir,
+                              processed_dir=event.processed_dir,
+                              dtype=np.float32 if args.float32 else float,
+                              n_samples=event.n_samples or process_data.N_SAMPLES,
+                              source=event.coordinates,
+                              start_time=event.start_time, end_time=event.end_time)
+
+
+def plot_map(args, event):
+    """Plot a map of all the stations and Hunga Tonga.
+    """
+    import plot
+    processed_data = processed_store(event)
+    lats, lons = processed_data["lats"], processed_data["lons"]
+    stations_coordinates = np.concatenate((lats[:, np.newaxis],
+                                           lons[:, np.newaxis]),
+                                          axis=1)
+    plot.geography(event.coordinates, stations_coordinates, 
+                   os.path.join(event.plots_dir, "map.pdf"))
+
+
+def plot_distances(args, event):
+    """Plot the sorted distances between the stations and Hunga Tonga.
+    """
+    import plot
+    processed_data = processed_store(event)
+    distances = processed_data["distances"]
+    plot.distances(distances,
+                   os.path.join(event.plots_dir, "distances.pdf"))
+
+
+def plot_fir(args, event):
+    """Plot the filter input responses of h1, h2 and h3.
+    """
+    import plot
+    plot.input_response(H_LIST,
+                        ["$h_1$", "$h_2$", "$h_3$"],
+                        os.path.join(event.plots_dir, "fir.pdf"))
+
+
+def plot_freq_spec(args, event):
+    """Plot the frequency spectrums of h1, h2 and h3.
+    """
+    import plot
+    plot.frequency_spectrum(H_LIST,
+                            ["$H_1$ - lowpass", "$H_2$ - bandpass", "$H_3$ - highpass"],
+                            side_by_side=True,
+                            filename=os.path.join(event.plots_dir, "freq_spec.pdf"))
+
+
+def quality_control(args, event):
+    """Flag the stations with bad signals from their power spectra.
+    """
+    import quality
+    flags = quality.quality_control(event.processed_dir, event.spectra_dir)
+    for name, flagged in zip(("dead", "noisy", "gappy"), flags):
+        if np.any(flagged):
+            print(f"{np.sum(flagged)} {name} stations: "\
+                  f"{', '.join(map(str, np.flatnonzero(flagged)))}")
+
+
+def filter_signals(args, event):
+    """Filter the signals of all stations with h1, h2 and h3, leaving out the
+    stations flagged by quality control.
+    """
+    import process_data
+    import quality
+    exclude = quality.excluded_stations(processed_store(event), event.spectra_dir)
+    process_data.filter_signals(H_LIST, event.processed_dir, event.filtered_dir,
+                                decimation=args.decimate, exclude=exclude)
+
+
+def plot_sections(args, event):
+    """Plot the signals of all stations filtered through h2, sorted by distance.
+    """
+    import plot
+    import storage
+    filtered = filtered_store(event)
+
+    processed_data = processed_store(event)
+    sort_inds = np.argsort(processed_data["distances"])
+    distances = processed_data["distances"][sort_inds]
+    times = processed_data.times.decimate(filtered.decimation)[sort_inds]
+    pyramid = storage.LodPyramid.open_or_build(filtered)
+    signals = [pyramid.envelope(1, i, n_points=2000) for i in sort_inds]
+
+    plot_filename = os.path.join(event.plots_dir, "sections.pdf")
+    plot.sections(signals, times, distances, plot_filename,
+                  min_time=event.start_time)
+
+
+def pick_arrival_times(args, event):
+    """Automatically pick the arrival times of the wave at all stations.
+    """
+    import picking
+    import quality
+    processed_data = processed_store(event)
+    filtered = filtered_store(event)
+    arrival_times, confidences = picking.pick_arrival_times(
+        filtered[1], processed_data.times.decimate(filtered.decimation),
+        min_time=event.arrivals_start,
+        exclude=quality.excluded_stations(processed_data, event.spectra_dir)
+    )
+    np.save(event.arrival_times_filename, arrival_times)
+    np.save(event.valids_filename, picking.confidence_to_validness(confidences))
+
+
+def prefetch(function, items, depth=3):
+    """Apply a function to items in a background thread, staying up to depth
+    items ahead of the caller.
+
+    Used to read the next stations from disk while the user looks at the
+    current one.
+
+    Arguments:
+        function: Function of one item.
+        items: Iterable with the items.
+        depth: Number of items loaded ahead. 3 by default.
+
+    Return:
+        Generator with function(item) for every item, in order.
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        futures = deque()
+        for item in items:
+            futures.append(executor.submit(function, item))
+            if len(futures) > depth:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def mark_arrival_times(args, event):
+    """Manually mark the arrival times of the wave at the stations.
+    """
+    import picking
+    import plot
+    import quality
+    import signal_processing
+    processed_data = processed_store(event)
+    data = processed_data["data"]
+    filtered = filtered_store(event)
+    times = processed_data.times.decimate(filtered.decimation)
     
-    if args.plot_sections:
-        signal_files = process_data.get_filenames(convolved_dir)
-        signal_files = sorted(list(filter(lambda s: "h2" in s, signal_files)))
-
-        processed_data = np.load(processed_data_filename)
-        sort_inds = np.argsort(processed_data["distances"])
-        distances = processed_data["distances"][sort_inds]
-        times = processed_data["times"][sort_inds]
-        signals = [signal_files[i] for i in sort_inds]
-
-        plot_filename = os.path.join(constants.PLOTS_DIR, "sections.pdf")
-        plot.sections(signals, times, distances, plot_filename)
+    if os.path.exists(event.arrival_times_filename):
+        arrival_times = np.load(event.arrival_times_filename)
+        valids = np.load(event.valids_filename)
+    else:
+        arrival_times = np.zeros(len(data), dtype=float)
+        valids = np.zeros_like(arrival_times)
     
-    if args.mark_arrival_times:
-        processed_data = np.load(processed_data_filename)
-        data = processed_data["data"]
-        times = processed_data["times"]
+    to_mark = arrival_times == 0
+    if args.review_below is not None:
+        to_mark |= picking.validness_to_weights(valids) < args.review_below
+    # Stations left out by quality control have no signals to mark, and
+    # weight 0 from their zeroed picks
+    to_mark &= ~quality.excluded_stations(processed_data, event.spectra_dir)
+    # Stations without at least two samples have nothing to show
+    to_mark &= times.lengths > 1
 
-        load_convolved = lambda h, station_id: np.load(os.path.join(convolved_dir, f"h{h}_x{station_id:03}.npy"))
-        
-        if os.path.exists(arrival_times_filename):
-            arrival_times = np.load(arrival_times_filename)
-            valids = np.load(valids_filename)
-        else:
-            arrival_times = np.zeros(len(data), dtype=float)
-            valids = np.zeros_like(arrival_times)
-        
-        for station_id, (x, t) in enumerate(zip(data, times)):
-            if arrival_times[station_id] != 0:
-                continue
-            
-            signals = {"Trace": x}
-            signals.update({f"$h_{j+1}$": load_convolved(j+1, station_id) for j in range(3)})
-            arrival_time, valid = plot.mark_arrival_time(station_id, t, **signals)
+    def load_station(station_id):
+        # Only the valid samples are shown, the padding after them has time 0
+        length = times.lengths[station_id]
+        # The trace is shown at the same rate as the filtered signals
+        trace = signal_processing.decimate(np.array(data[station_id]),
+                                           filtered.decimation)
+        signals = {"Trace": trace[:length]}
+        signals.update({f"$h_{j+1}$": np.array(y[:length])
+                        for j, y in enumerate(filtered[:, station_id])})
+        return station_id, times.row(station_id)[:length], signals
+
+    marker = plot.ArrivalTimeMarker(1 + filtered.shape[0])
+    try:
+        for station_id, t, signals in prefetch(load_station,
+                                               np.flatnonzero(to_mark)):
+            arrival_time, valid = marker.mark(station_id, t, **signals)
             arrival_times[station_id] = arrival_time
             valids[station_id] = valid
-            
+
             # Continually save the arrays in case the script crashes
-            np.save(arrival_times_filename, arrival_times)
-            np.save(valids_filename, valids)
-
-    if args.plot_arrival_times:
-        distances = np.load(processed_data_filename)["distances"]
-        arrival_times = np.load(arrival_times_filename)
-        validness = np.load(valids_filename)
-        weights = np.where(validness < 0, np.maximum(0, 1 + validness), 1)
-            
-        valid_entries = arrival_times > 1.642218e09
-        arrival_times = arrival_times[valid_entries]
-        distances = distances[valid_entries]/1000
-        weights = weights[valid_entries]
-
-        poly = np.polynomial.polynomial.Polynomial.fit(arrival_times, distances,
-                                                       deg=1, w=weights)
-
-        plot_filename = os.path.join(constants.PLOTS_DIR, "arrival_times.pdf")
-        plot.arrival_time_vs_distance(distances, arrival_times, weights,
-                                      poly, plot_filename)
+            np.save(event.arrival_times_filename, arrival_times)
+            np.save(event.valids_filename, valids)
+    finally:
+        marker.close()
+
+
+def stream(args, event):
+    """Filter and pick arrival times from waveform chunks as they arrive.
+    """
+    import picking
+    import streaming
+    if os.path.isdir(args.stream):
+        source = streaming.directory_source(args.stream)
+    else:
+        host, port = args.stream.rsplit(":", 1)
+        source = streaming.socket_source((host, int(port)))
+
+    # The station metadata is taken from the processed data
+    times = processed_store(event).times
+    reported = np.zeros(len(times), dtype=float)
+    for _, arrival_times, confidences in streaming.run(
+            source, H_LIST, times, event.streamed_filename,
+            min_time=event.arrivals_start):
+        # Report confident picks as they appear or change
+        new_picks = (confidences >= 0.5) & (arrival_times != reported)
+        for station_id in np.flatnonzero(new_picks):
+            print(f"Station {station_id}: arrival at "\
+                  f"{datetime.datetime.fromtimestamp(arrival_times[station_id])}"\
+                  f" (confidence {confidences[station_id]:.2f})")
+        reported[new_picks] = arrival_times[new_picks]
+
+    np.save(event.arrival_times_filename, arrival_times)
+    np.save(event.valids_filename, picking.confidence_to_validness(confidences))
+
+
+def load_arrival_times(event):
+    """Load the arrival times of an event, refined by --refine-arrival-times if
+    they were refined after they were last picked or marked.
+    """
+    refined = event.refined_arrival_times_filename
+    if (os.path.exists(refined) and os.path.getmtime(refined)
+            >= os.path.getmtime(event.arrival_times_filename)):
+        return np.load(refined)
+    return np.load(event.arrival_times_filename)
+
+
+def refine_arrival_times(args, event):
+    """Refine the arrival times of the wave with cross-correlations between
+    neighbouring stations.
+    """
+    import picking
+    import refinement
+    processed_data = processed_store(event)
+    filtered = filtered_store(event)
+    arrival_times = np.load(event.arrival_times_filename)
+    weights = picking.validness_to_weights(np.load(event.valids_filename))
+    weights[arrival_times <= event.arrivals_start] = 0
+
+    refined = refinement.refine_arrival_times(
+        filtered[1], processed_data.times.decimate(filtered.decimation),
+        processed_data["lats"], processed_data["lons"], arrival_times, weights,
+        keys=filtered.header["keys"], path=event.correlations_dir
+    )
+    shifts = np.abs(refined - arrival_times)[weights > 0]
+    if len(shifts):
+        print(f"Refined {len(shifts)} arrival times, shifted by "\
+              f"{np.median(shifts):.1f} s in the median and "\
+              f"{np.max(shifts):.1f} s at most")
+    # Saved apart from the picks, so refining again starts from them instead
+    # of adding shifts to already refined arrival times
+    np.save(event.refined_arrival_times_filename, refined)
+
+
+def plot_arrival_times(args, event):
+    """Plot the arrival times of the wave against the distances of the stations,
+    with the uncertainty of the fitted line.
+    """
+    import picking
+    import plot
+    import uncertainty
+    distances = processed_store(event)["distances"]
+    arrival_times = load_arrival_times(event)
+    validness = np.load(event.valids_filename)
+    weights = picking.validness_to_weights(validness)
+        
+    valid_entries = arrival_times > event.arrivals_start
+    arrival_times = arrival_times[valid_entries]
+    distances = distances[valid_entries]/1000
+    weights = weights[valid_entries]
+
+    poly = np.polynomial.polynomial.Polynomial.fit(arrival_times, distances,
+                                                   deg=1, w=weights)
+
+    fit = uncertainty.line_fit_uncertainty(arrival_times, distances, weights,
+                                           n_resamples=args.resamples)
+    low, high = fit["speed_interval"]
+    print(f"Propagation speed {1000*fit['speed']:.1f} m/s, 95% interval "\
+          f"{1000*low:.1f} to {1000*high:.1f} m/s, jackknife standard error "\
+          f"{1000*fit['speed_error']:.1f} m/s")
+    low, high = fit["origin_time_interval"]
+    print(f"Origin time {datetime.datetime.fromtimestamp(fit['origin_time'])}, "\
+          f"95% interval {datetime.datetime.fromtimestamp(low)} to "\
+          f"{datetime.datetime.fromtimestamp(high)}, jackknife standard error "\
+          f"{fit['origin_time_error']:.0f} s")
+
+    band_times = np.linspace(np.min(arrival_times), np.max(arrival_times), 200)
+    band = (band_times,) + uncertainty.line_band(fit, band_times)
+
+    plot_filename = os.path.join(event.plots_dir, "arrival_times.pdf")
+    plot.arrival_time_vs_distance(distances, arrival_times, weights,
+                                  poly, band, plot_filename)
+
+
+def locate_source(args, event):
+    """Locate the source of the wave from the arrival times, and plot the
+    misfit of the candidate sources.
+    """
+    import localization
+    import picking
+    import plot
+    processed_data = processed_store(event)
+    lats, lons = processed_data["lats"], processed_data["lons"]
+    arrival_times = load_arrival_times(event)
+    weights = picking.validness_to_weights(np.load(event.valids_filename))
+    weights[arrival_times <= event.arrivals_start] = 0
+
+    source, (grid_lats, grid_lons, misfit) = localization.locate(
+        lats, lons, arrival_times, weights, workers=args.workers
+    )
+    print(f"Source at {source['latitude']:.3f}, {source['longitude']:.3f} at "\
+          f"{datetime.datetime.fromtimestamp(source['origin_time'])}, with a "\
+          f"celerity of {source['celerity']:.1f} m/s (RMS misfit "\
+          f"{source['misfit']:.1f} s)")
+    np.savez(event.source_filename, grid_lats=grid_lats, grid_lons=grid_lons,
+             misfit_surface=misfit, **source)
+
+    stations_coordinates = np.stack((lats, lons), axis=1)
+    plot.misfit_surface(grid_lats, grid_lons, misfit, source, stations_coordinates,
+                        event.coordinates,
+                        os.path.join(event.plots_dir, "source.pdf"),
+                        reference_label=event.name.replace("_", " ").title())
+
+
+# All actions, in the order they are run
+ACTIONS = {action.__name__: action for action in (
+    parse_data, plot_map, plot_distances, plot_fir, plot_freq_spec,
+    quality_control, filter_signals, plot_sections, pick_arrival_times, mark_arrival_times,
+    stream, refine_arrival_times, plot_arrival_times, locate_source
+)}
+
+
+# Actions whose outputs every action reads directly, if they are requested too
+DEPENDENCIES = {
+    "parse_data": set(),
+    "plot_map": {"parse_data"},
+    "plot_distances": {"parse_data"},
+    "plot_fir": set(),
+    "plot_freq_spec": set(),
+    "quality_control": {"parse_data"},
+    "filter_signals": {"parse_data", "quality_control"},
+    "plot_sections": {"parse_data", "filter_signals"},
+    "pick_arrival_times": {"parse_data", "quality_control", "filter_signals"},
+    "mark_arrival_times": {"parse_data", "quality_control", "filter_signals",
+                           "pick_arrival_times"},
+    "stream": {"parse_data"},
+    "refine_arrival_times": {"parse_data", "filter_signals", "pick_arrival_times",
+                             "mark_arrival_times", "stream"},
+    "plot_arrival_times": {"parse_data", "pick_arrival_times", "mark_arrival_times",
+                           "stream", "refine_arrival_times"},
+    "locate_source": {"parse_data", "pick_arrival_times", "mark_arrival_times",
+                      "stream", "refine_arrival_times"},
+}
+
+
+def all_dependencies(name):
+    """Get every action an action depends on, directly or through the actions
+    it depends on.
+    """
+    found = set()
+    unvisited = list(DEPENDENCIES[name])
+    while unvisited:
+        dependency = unvisited.pop()
+        if dependency not in found:
+            found.add(dependency)
+            unvisited.extend(DEPENDENCIES[dependency])
+    return found
+
+
+# Actions that need the user, so they are always run in the main process
+INTERACTIVE = {"mark_arrival_times"}
+
+
+def _init_worker(profile, cprofile):
+    # Workers only save plots, and must not open windows
+    import matplotlib
+    matplotlib.use("Agg")
+    if profile is not None:
+        profiling.enable(profile, cprofile)
+
+
+def _run_action(name, args, event):
+    """Run an action in a worker process, returning what it recorded so it can
+    be merged into the main process.
+    """
+    profiling.profiler.events = []
+    cache.stats.counts = {}
+    with profiling.stage(name):
+        ACTIONS[name](args, event)
+    return profiling.profiler.export(), cache.stats.counts
+
+
+def run_actions(names, args, event, jobs=1):
+    """Run actions once the actions they depend on are done.
+
+    Arguments:
+        names: Names of the actions to run.
+        args: Parsed arguments given to the actions.
+        event: catalog.Event the actions are run for.
+        jobs: Number of processes running actions at the same time. 1 by
+              default, meaning they are run one after another in this process.
+    """
+    if jobs == 1:
+        for name in names:
+            with profiling.stage(name):
+                ACTIONS[name](args, event)
+        return
+
+    # Dependencies through actions that weren't requested still count, since
+    # e.g. plot_arrival_times reads what parse_data writes even without
+    # pick_arrival_times between them
+    waiting = {name: all_dependencies(name) & set(names) for name in names}
+    running = {}
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                             initargs=(args.profile, args.cprofile)) as executor:
+        while waiting or running:
+            unfinished = set(waiting) | set(running.values())
+            ready = [name for name, dependencies in waiting.items()
+                     if not dependencies & unfinished]
+            for name in ready:
+                del waiting[name]
+                if name not in INTERACTIVE:
+                    running[executor.submit(_run_action, name, args, event)] = name
+            for name in ready:
+                if name in INTERACTIVE:
+                    with profiling.stage(name):
+                        ACTIONS[name](args, event)
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                # Raises the exception of a failed action, stopping the rest
+                exported, counts = future.result()
+                profiling.profiler.merge(exported)
+                cache.stats.merge(counts)
+
+
+def _init_event_worker(profile, cprofile, memory_limit):
+    _init_worker(profile, cprofile)
+    if memory_limit is not None:
+        # Inherited by the processes the event starts itself
+        resource.setrlimit(resource.RLIMIT_DATA, (memory_limit, memory_limit))
+
+
+def _run_event(names, args, event):
+    """Run actions for an event in a worker process, see _run_action.
+    """
+    profiling.profiler.events = []
+    cache.stats.counts = {}
+    event.make_dirs()
+    with profiling.stage(f"event {event.name}"):
+        run_actions(names, args, event, args.jobs)
+    return profiling.profiler.export(), cache.stats.counts
+
+
+def processes_per_event(args):
+    """Get the most processes a single event may use at the same time: the
+    event worker itself, the args.jobs processes running its actions, and
+    the args.workers processes each of those may start, e.g. in
+    process_data.process_data or localization.grid_search.
+    """
+    workers = 1 + (args.workers if args.workers > 1 else 0)
+    if args.jobs > 1:
+        return 1 + args.jobs*workers
+    return workers
+
+
+def run_catalog(names, args, events):
+    """Run actions for many events, in parallel processes.
+
+    An event failing, e.g. by running out of memory, doesn't stop the others.
+
+    Arguments:
+        names: Names of the actions to run for every event.
+        args: Parsed arguments given to the actions. args.event_workers events
+              are processed at the same time, each running actions in
+              args.jobs processes, and args.memory_limit is split evenly
+              between all the processes they may start, see
+              processes_per_event.
+        events: List of catalog.Event.
+
+    Return:
+        List with the names of the events that failed.
+    """
+    memory_limit = None
+    if args.memory_limit is not None:
+        # Every process inherits the limit of the event worker, so it is the
+        # share of a single process
+        memory_limit = int(args.memory_limit*2**20
+                           /(args.event_workers*processes_per_event(args)))
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.event_workers,
+                             initializer=_init_event_worker,
+                             initargs=(args.profile, args.cprofile,
+                                       memory_limit)) as executor:
+        futures = {executor.submit(_run_event, names, args, event): event
+                   for event in events}
+        for future in as_completed(futures):
+            event = futures[future]
+            try:
+                exported, counts = future.result()
+            except Exception as error:
+                print(f"Event {event.name} failed: {error!r}")
+                failed.append(event.name)
+                continue
+            profiling.profiler.merge(exported)
+            cache.stats.merge(counts)
+            print(f"Event {event.name} done")
+    return failed
+
+
+def main():
+    args = parse_arguments()
+
+    if args.profile is not None:
+        profiling.enable(args.profile, args.cprofile)
+
+    names = [name for name in ACTIONS if getattr(args, name)]
+    failed = []
+    if args.catalog is None:
+        run_actions(names, args, catalog.HUNGA_TONGA, args.jobs)
+    elif INTERACTIVE & set(names):
+        sys.exit("--mark-arrival-times needs the user, so it can't be used "\
+                 "with --catalog")
+    else:
+        failed = run_catalog(names, args, catalog.load_catalog(args.catalog))
+
+    if cache.stats.counts:
+        print(cache.stats.report())
+    profiling.profiler.save()
+    if failed:
+        sys.exit(f"{len(failed)} events failed: {', '.join(failed)}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,84 @@
+"""Automatic picking of the arrival times of the wave at the stations.
+"""
+import numpy as np
+
+import signal_processing
+
+
+def validness_to_weights(validness):
+    """Turn the validness of arrival times into weights between 0 and 1.
+
+    Arguments:
+        validness: Array where 1 means an arrival time is completely valid, and
+                   negative values how far from valid it is, like the values
+                   returned by plot.mark_arrival_time.
+
+    Return:
+        Array with weights, with the same shape as validness.
+    """
+    return np.where(validness < 0, np.maximum(0, 1 + validness), 1)
+
+
+def confidence_to_validness(confidence):
+    """Inverse of validness_to_weights, for confidences between 0 and 1.
+    """
+    return np.where(confidence >= 1, 1, confidence - 1)
+
+
+def pick_arrival_times(signals, times, sta_window=600, lta_window=3600,
+                       saturation_ratio=10, min_time=None, block_size=8,
+                       exclude=None):
+    """Pick the arrival times of the wave at all stations with STA/LTA.
+
+    The characteristic function is the ratio between the short and long term
+    average energy of each signal, computed for blocks of stations at once
+    with signal_processing.sta_lta. The arrival time is where it peaks, and the
+    confidence of the pick grows linearly with the peak ratio, from 0 at a
+    ratio of 1 (no change in energy) to 1 at saturation_ratio.
+
+    Arguments:
+        signals: 2-d array with the (filtered) signal of every station, e.g.
+                 one filter of a storage.FilteredStore.
+        times: time_axis.TimeAxis with the times of the signals.
+        sta_window: Length of the short term window in seconds. 600 by default.
+        lta_window: Length of the long term window in seconds. 3600 by default.
+        saturation_ratio: Peak ratio giving a confidence of 1. 10 by default.
+        min_time: Ignore everything before this time, given in seconds since
+                  the UNIX epoch. None by default, meaning nothing is ignored.
+        block_size: Number of stations processed at once. 8 by default.
+        exclude: Boolean array telling which stations to leave out, e.g. from
+                 quality.excluded_stations. They get an arrival time and
+                 confidence of 0. None by default, meaning none are left out.
+
+    Return:
+        Arrays with the arrival time, and the confidence between 0 and 1, for
+        every station.
+    """
+    n_stations = len(signals)
+    arrival_times = np.zeros(n_stations, dtype=float)
+    confidences = np.zeros(n_stations, dtype=float)
+
+    for start in range(0, n_stations, block_size):
+        stop = min(start + block_size, n_stations)
+        block_times = times[start:stop]
+        n_sta = np.maximum(1, np.round(sta_window/block_times.deltas)).astype(int)
+        n_lta = np.maximum(1, np.round(lta_window/block_times.deltas)).astype(int)
+
+        ratio = signal_processing.sta_lta(signals[start:stop], n_sta, n_lta)
+
+        # Only consider the valid samples, after min_time
+        samples = np.arange(ratio.shape[1])[np.newaxis, :]
+        ratio[samples >= block_times.lengths[:, np.newaxis]] = 0
+        if min_time is not None:
+            ratio[block_times.at(samples) < min_time] = 0
+
+        peaks = np.argmax(ratio, axis=1)
+        peak_ratios = ratio[np.arange(stop - start), peaks]
+        arrival_times[start:stop] = block_times.at(peaks)
+        confidences[start:stop] = np.clip((peak_ratios - 1)/(saturation_ratio - 1),
+                                          0, 1)
+
+    if exclude is not None:
+        arrival_times[exclude] = 0
+        confidences[exclude] = 0
+    return arrival_times, confidences
@@ -1,12 +1,85 @@
 """Module with functions to make the plots necessary for the report.
 """
-import cartopy.crs as ccrs
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 import datetime
 
+import cache
+import profiling
 import signal_processing
+import storage
+
+
+def show_or_save(filename=None):
+    """Show the current figure, or render it to a file and close it.
+
+    Arguments:
+        filename: Path to location to save the image in. If None, as default,
+                  it isn't saved just shown.
+    """
+    if filename is None:
+        plt.show()
+    else:
+        with profiling.stage("render"):
+            plt.savefig(filename)
+        plt.close()
+
+def stock_basemap(ax, regrid_shape=750, path=None):
+    """Draw the stock image of cartopy as the background of a map, like
+    ax.stock_img, but from a cached reprojection of it.
+
+    Reprojecting the global raster to the projection of the map is the
+    slowest part of drawing it, so the reprojected raster is saved in a
+    storage.BasemapCache, keyed by the projection with its centre, the extent
+    of the map and the size of the figure, and reused by later maps.
+
+    Arguments:
+        ax: cartopy GeoAxes to draw on.
+        regrid_shape: Length of the shortest side of the reprojected raster in
+                      pixels. 750 by default, like ax.stock_img.
+        path: Directory of the cache. constants.BASEMAP_DIR by default.
+    """
+    import cartopy
+    import cartopy.crs as ccrs
+
+    projection = ax.projection
+    extent = ax.get_extent(projection)
+    width, height = extent[1] - extent[0], extent[3] - extent[2]
+    scale = regrid_shape/min(width, height)
+    shape = (int(round(width*scale)), int(round(height*scale)))
+    key = cache.digest(projection=projection.proj4_init, extent=extent, shape=shape,
+                       figsize=ax.figure.get_size_inches(), cartopy=cartopy.__version__)
+
+    basemaps = storage.BasemapCache(path)
+    stored = basemaps.load(key)
+    if stored is None:
+        cache.stats.miss("basemap")
+        from cartopy.img_transform import warp_array
+        source = plt.imread(cartopy.config["repo_data_dir"] / "raster" / "natural_earth"
+                            / "50-natural-earth-1-downsampled.png")
+        # warp_array expects the first row at the bottom
+        warped, warped_extent = warp_array(source[::-1], projection,
+                                           source_proj=ccrs.PlateCarree(),
+                                           target_res=shape,
+                                           source_extent=(-180, 180, -90, 90),
+                                           target_extent=extent,
+                                           mask_extrapolated=True)
+        image = np.zeros(warped.shape[:2] + (4,), dtype=np.uint8)
+        colors = np.ma.getdata(warped)[..., :3]
+        if colors.dtype.kind == "f":
+            colors = np.round(255*np.clip(colors, 0, 1))
+        image[..., :3] = colors
+        image[..., 3] = np.where(np.ma.getmaskarray(warped).any(axis=-1), 0, 255)
+        stored = (image, warped_extent)
+        basemaps.save(key, *stored)
+    else:
+        cache.stats.hit("basemap")
+
+    image, image_extent = stored
+    # In the projection of the map, so cartopy draws it without reprojecting
+    ax.imshow(image, origin="lower", extent=image_extent, transform=projection)
+
 
 def geography(center_coordinates, other_coordinates, filename=None):
     """Plot a map of the world with some coordinates marked.
@@ -18,23 +91,27 @@ def geography(center_coordinates, other_coordinates, filename=None):
         filename: Path to location to save resulting image in. If None, as 
                   default, it isn't saved just shown.
     """
+    # cartopy is slow to import, and only needed for maps
+    import cartopy.crs as ccrs
+
     fig, ax = plt.subplots(1, 1, figsize=(7, 4))
     
     projection = ccrs.AzimuthalEquidistant(*reversed(center_coordinates))
     ax = plt.axes(projection=projection)
-    ax.stock_img()
-    
-    ax.scatter(other_coordinates[:,1], other_coordinates[:,0], marker="x", s=20, color="xkcd:bright blue", transform=ccrs.PlateCarree())
-    ax.scatter([center_coordinates[1]], [center_coordinates[0]], marker="^", s=50, color="xkcd:brick red", transform=ccrs.PlateCarree())
+    stock_basemap(ax)
+
+    # All the markers are projected at once, instead of by cartopy when drawn
+    coordinates = np.concatenate((np.asarray(other_coordinates, dtype=float),
+                                  [center_coordinates]))
+    points = projection.transform_points(ccrs.PlateCarree(), coordinates[:,1],
+                                         coordinates[:,0])
+    ax.scatter(points[:-1,0], points[:-1,1], marker="x", s=20, color="xkcd:bright blue")
+    ax.scatter(points[-1:,0], points[-1:,1], marker="^", s=50, color="xkcd:brick red")
     
     ax.set_xticks([])
     ax.set_yticks([])
         
-    if filename is None:
-        plt.show()
-    else:
-        plt.savefig(filename)
-        plt.close()
+    show_or_save(filename)
 
 
 def distances(distance_array, filename=None):
@@ -62,11 +139,7 @@ def distances(distance_array, filename=None):
                label=f"Farthest station ({int(farthest)}km)")
     plt.legend()
     
-    if filename is None:
-        plt.show()
-    else:
-        plt.savefig(filename)
-        plt.close()
+    show_or_save(filename)
 
 
 def input_response(fir, fir_label=None, filename=None):
@@ -98,11 +171,7 @@ def input_response(fir, fir_label=None, filename=None):
     ax.set_ylabel("$h$")
     plt.legend()
 
-    if filename is None:
-        plt.show()
-    else:
-        plt.savefig(filename)
-        plt.close()
+    show_or_save(filename)
 
 
 def frequency_spectrum(fir, fir_label=None, side_by_side=False, filename=None):
@@ -148,33 +217,58 @@ def frequency_spectrum(fir, fir_label=None, side_by_side=False, filename=None):
 
     fig.suptitle("Absolute values of the frequency spectrums of the FIRs")
 
-    if filename is None:
-        plt.show()
-    else:
-        plt.savefig(filename)
-        plt.close()
+    show_or_save(filename)
+
 
+def sections(signals, times, distances, plot_filename=None, n_points=2000,
+             min_time=None):
+    """Plot many signals from many different stations, all transformed by the
+    same filter.
 
-def sections(signal_filenames, times, distances, plot_filename=None):
-    """Plot many signals from many different files, all transformed by filter 3.
+    Every signal is drawn as a min/max envelope with about n_points bins, which
+    looks the same as plotting all the samples, but is much faster to render.
 
     Arguments:  
-        signal_filenames: Paths to numpy files with arrays for each signal.
-        times: 2-d array giving the times of each of the measurements.
+        signals: Sequence with either 1-d arrays with each signal, e.g. rows of
+                 a storage.FilteredStore, or envelopes of them, given as tuples
+                 like those from storage.LodPyramid.envelope.
+        times: 2-d array giving the times of each of the measurements, or a
+               time_axis.TimeAxis.
         distances: 1-d array stating how far away from Hunga Tunga each signal is
                    from.
         plot_filename: Path to location to save resulting image in. If None, as 
                        default, it isn't saved just shown.
+        n_points: Number of bins signals given as arrays are reduced to. 2000 by
+                  default, about twice the pixel width of the figure.
+        min_time: Measurements before this are not drawn, given in seconds
+                  since the UNIX epoch. None by default, meaning only the zero
+                  padding after the measurements is left out.
     """
     fig, ax = plt.subplots(1, 1, figsize=(7, 4))
     
     max_distance = np.max(distances)
-    for i, (signal_filename, _times, distance) in enumerate(zip(signal_filenames, times, distances)):
-        y = np.abs(np.load(signal_filename))
-        # Remove measurements from before the event
-        keep_inds = _times > 4.92e06
-        scaled_y = (max_distance/100 * y[keep_inds]/max(1, np.max(y)) + distance)/1000
-        ax.plot(_times[keep_inds], scaled_y, color="black", alpha=0.7, linewidth=0.2)
+    for i, (signal, _times, distance) in enumerate(zip(signals, times, distances)):
+        if isinstance(signal, tuple):
+            samples, lower, upper = signal
+        else:
+            factor = max(1, len(signal) // n_points)
+            lower, upper = signal_processing.minmax_envelope(signal, factor)
+            samples = np.arange(len(lower))*factor
+
+        # Envelope of the absolute value of the signal
+        y_lower = np.where((lower <= 0) & (upper >= 0), 0,
+                           np.minimum(np.abs(lower), np.abs(upper)))
+        y_upper = np.maximum(np.abs(lower), np.abs(upper))
+
+        # Remove measurements from before the event, and the padding
+        bin_times = _times[samples]
+        keep_inds = bin_times > (0 if min_time is None else min_time)
+        scale = max_distance/100/max(1, np.max(y_upper))
+        # Draw every bin as a vertical line from its minimum to its maximum
+        x = np.repeat(bin_times[keep_inds], 2)
+        y = np.stack((y_lower[keep_inds], y_upper[keep_inds]), axis=1).ravel()
+        ax.plot(x, (scale*y + distance)/1000, color="black", alpha=0.7,
+                linewidth=0.2)
 
     ticks = np.linspace(np.min(times[0]), np.max(times[0]), 8)
     ticklabels = [datetime.datetime.fromtimestamp(tick).strftime("%H:%M") for tick in ticks]
@@ -182,47 +276,125 @@ def sections(signal_filenames, times, distances, plot_filename=None):
     ax.set_xlabel("Time")
     ax.set_ylabel("Distance (km)")
 
-    if plot_filename is None:
-        plt.show()
-    else:
-        plt.savefig(plot_filename)
-        plt.close()
+    show_or_save(plot_filename)
+
+
+class ArrivalTimeMarker:
+    """Figure for marking the arrival times of the wave at one station after
+    another, with pyplot.ginput.
+
+    The figure is made once and reused for every station. Every signal is
+    drawn as a min/max envelope with about n_points bins of the samples in
+    view, and drawn again whenever an axis is zoomed or panned, so zooming in
+    shows the signal at full resolution.
+
+    Arguments:
+        n_signals: Number of signals shown for every station.
+        n_points: Number of bins the samples in view are reduced to. 2000 by
+                  default, about twice the pixel width of an axis.
+    """
+    def __init__(self, n_signals, n_points=2000):
+        self.n_points = n_points
+        self.fig, axs = plt.subplots(2, int(np.ceil(n_signals/2)), figsize=(12, 7))
+        self.axs = list(np.atleast_1d(axs).flat)[:n_signals]
+        self.lines = [ax.plot([], [])[0] for ax in self.axs]
+        self.spans = []
+        self.signals = [np.zeros(0)]*n_signals
+        self.signal_times = np.zeros(0)
+        for k, ax in enumerate(self.axs):
+            ax.callbacks.connect("xlim_changed",
+                                 lambda ax, k=k: self._draw_view(k))
+
+    def _draw_view(self, k):
+        signal = self.signals[k]
+        x_min, x_max = self.axs[k].get_xlim()
+        start, stop = np.searchsorted(self.signal_times, [x_min, x_max])
+        start, stop = max(0, start - 1), min(len(signal), stop + 1)
+
+        if stop - start <= 2*self.n_points:
+            x, y = self.signal_times[start:stop], signal[start:stop]
+        else:
+            factor = (stop - start) // self.n_points
+            lower, upper = signal_processing.minmax_envelope(signal[start:stop], factor)
+            # Every bin is drawn as a vertical line from its minimum to its maximum
+            x = np.repeat(self.signal_times[start:stop:factor], 2)
+            y = np.stack((lower, upper), axis=1).ravel()
+        self.lines[k].set_data(x, y)
+        self.fig.canvas.draw_idle()
+
+    def mark(self, station_id, signal_times, **signals):
+        """Show the signals of a station, and let the user click once to mark
+        the arrival time of the infrasound wave.
+
+        Arguments:
+            station_id: Index of the station to plot for
+            signal_times: 1-d array with the increasing times of the
+                          measurements, i.e. the valid samples of a row of the
+                          time_axis.TimeAxis of the processed data
+            **signals: Named 1-d slice of the 'data'-array in the processed
+                       data store, or processed versions of it.
+
+        Return:
+            Float indicating the arrival time estimated by the user, and the
+            validness of the mark, which is 1 if the user clicked above 0.
+        """
+        self.fig.suptitle(f"Station number {station_id}")
+        self.signal_times = np.asarray(signal_times)
+        self.signals = [np.asarray(signal) for signal in signals.values()]
+        for span in self.spans:
+            span.remove()
+        self.spans = []
+
+        for k, (ax, signal_name) in enumerate(zip(self.axs, signals)):
+            signal = self.signals[k]
+            self.spans.append(ax.axhspan(0, np.max(signal), color="xkcd:light green",
+                                         alpha=0.4))
+            self.spans.append(ax.axhspan(np.min(signal), 0, color="xkcd:burnt orange",
+                                         alpha=0.4))
+            ax.set_title(signal_name)
+            # Draws the envelope of the whole signal, through _draw_view
+            ax.set_xlim(self.signal_times[0], self.signal_times[-1])
+            ax.relim()
+            ax.autoscale_view(scalex=False)
+
+        # The zoom history of the last station doesn't apply to this one
+        if self.fig.canvas.toolbar is not None:
+            self.fig.canvas.toolbar.update()
+
+        arrival_time, height = self.fig.ginput()[0]
+        validness = 1 if height > 0 else height/np.max(np.abs(self.signals[-1]))
+        return arrival_time, validness
+
+    def close(self):
+        plt.close(self.fig)
 
 
 def mark_arrival_time(station_id, signal_times, **signals):
     """Use pyplot.ginput to mark the arrival time of the wave at a station.
 
     Opens a plot, and lets the user click once to mark the arrival time of the
-    infrasound wave.
+    infrasound wave. Use ArrivalTimeMarker to mark many stations in the same
+    figure.
 
     Arguments:
         station_id: Index of the station to plot for
-        signal_times: 1-d slice of the 'times'-array in the processed data 
-                      npz-file
+        signal_times: 1-d array with the times of the measurements, i.e. a row
+                      of the time_axis.TimeAxis of the processed data
         **signals: Named 1-d slice of the 'data'-array in the processed data
-                   npz-file, or processed versions of it.
+                   store, or processed versions of it.
 
     Return:
         Float indicating the arrival time estimated by the user.
     """
-    fig, axs = plt.subplots(2, int(np.ceil(len(signals)/2)), figsize=(12, 7))
-
-    fig.suptitle(f"Station number {station_id}")
-
-    for ax, (signal_name, signal) in zip(axs.flat, signals.items()):
-        ax.plot(signal_times, signal)
-        ax.fill_between([signal_times[0], signal_times[-1]], 0, np.max(signal), color="xkcd:light green", alpha=0.4)
-        ax.fill_between([signal_times[0], signal_times[-1]], np.min(signal), 0, color="xkcd:burnt orange", alpha=0.4)
-        ax.set_title(signal_name)
-
-    arrival_time, height = plt.ginput()[0]
-    plt.close()
-    validness = 1 if height > 0 else height/np.max(np.abs(signal))
-    return arrival_time, validness
+    marker = ArrivalTimeMarker(len(signals))
+    try:
+        return marker.mark(station_id, signal_times, **signals)
+    finally:
+        marker.close()
 
 
 def arrival_time_vs_distance(distances, arrival_times, alphas=None,
-                             polynomial=None, filename=None):
+                             polynomial=None, band=None, filename=None):
     """Plot the arrival time of the signal against distance.
 
     Arguments:
@@ -236,6 +408,10 @@ def arrival_time_vs_distance(distances, arrival_times, alphas=None,
                    probability of its validity.
         polynomial: Numpy polynomial fitted to the data. None by default, meaning
                     not polynomial is plotted.
+        band: Tuple with arrays of times, and the lower and upper distance of
+              the confidence band of the fit at them, e.g. from
+              uncertainty.line_band. None by default, meaning no band is
+              plotted.
         filename: Path to location to save resulting image in. If None, as 
                   default, it isn't saved just shown.
     """
@@ -250,6 +426,11 @@ def arrival_time_vs_distance(distances, arrival_times, alphas=None,
         label = "$" + " + ".join([f"{coef:.4g} \\cdot x^{i}" for i, coef in enumerate(polynomial.convert().coef)]) +  "$"
         ax.plot(arrival_times, polynomial(arrival_times), label=label)
 
+    if band is not None:
+        band_times, lower, upper = band
+        ax.fill_between(band_times, lower, upper, color="xkcd:light blue", alpha=0.4,
+                        label="Bootstrap confidence band")
+
     ax.scatter(arrival_times, distances, c=colors)
 
     ticks = np.linspace(np.min(arrival_times), np.max(arrival_times), 8)
@@ -259,8 +440,45 @@ def arrival_time_vs_distance(distances, arrival_times, alphas=None,
     ax.set_ylabel("Distance (km)")
     plt.legend()
 
-    if filename is None:
-        plt.show()
-    else:
-        plt.savefig(filename)
-        plt.close()
+    show_or_save(filename)
+
+
+def misfit_surface(grid_lats, grid_lons, misfit, source, stations_coordinates,
+                   reference_coordinates=None, filename=None,
+                   reference_label="Reference"):
+    """Plot a map of the misfit of candidate sources of the wave.
+
+    Arguments:
+        grid_lats: 1-d array with the latitudes of the grid in degrees.
+        grid_lons: 1-d array with the longitudes of the grid in degrees.
+        misfit: 2-d array with the misfit at every node of the grid in
+                seconds, indexed by (latitude, longitude).
+        source: Dictionary with the latitude and longitude of the best source,
+                like the one returned by localization.locate.
+        stations_coordinates: 2D arraylike with the coordinates of the
+                              stations.
+        reference_coordinates: Tuple with the latitude and longitude of a
+                               known source to compare with. Optional.
+        filename: Path to location to save resulting image in. If None, as
+                  default, it isn't saved just shown.
+        reference_label: Legend label of the known source, e.g. the name of
+                         the event. "Reference" by default.
+    """
+    import cartopy.crs as ccrs
+
+    fig = plt.figure(figsize=(7, 4))
+    ax = plt.axes(projection=ccrs.PlateCarree())
+    ax.stock_img()
+
+    mesh = ax.pcolormesh(grid_lons, grid_lats, misfit/60, shading="nearest",
+                         norm=matplotlib.colors.LogNorm(), alpha=0.7,
+                         transform=ccrs.PlateCarree())
+    fig.colorbar(mesh, ax=ax, label="RMS misfit (minutes)")
+
+    ax.scatter(stations_coordinates[:,1], stations_coordinates[:,0], marker="x", s=10, color="xkcd:bright blue", transform=ccrs.PlateCarree())
+    if reference_coordinates is not None:
+        ax.scatter([reference_coordinates[1]], [reference_coordinates[0]], marker="^", s=50, color="xkcd:brick red", transform=ccrs.PlateCarree(), label=reference_label)
+    ax.scatter([source["longitude"]], [source["latitude"]], marker="*", s=80, color="xkcd:goldenrod", transform=ccrs.PlateCarree(), label=f"Best source ({source['celerity']:.1f} m/s)")
+    plt.legend(loc="lower left")
+
+    show_or_save(filename)
@@ -4,11 +4,20 @@ import os
 import h5py
 from datetime import datetime
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import haversine as hs
 
+import cache
 import constants
+import profiling
+import signal_processing
+import storage
+
+N_SAMPLES = 720000
+# Fields with one value for every station, in the order _ingest_station returns them
+METADATA_FIELDS = ("starttimes", "deltas", "lengths", "lats", "lons", "distances")
 
 def get_filenames(path):
     """Get names of all files in `path`.
@@ -31,35 +40,241 @@ def distance(coordinates, other_coordinates):
     return hs.haversine(coordinates, other_coordinates, unit=hs.Unit.METERS)
 
 
-def process_data():
-    raw_filenames = get_filenames(os.path.join(constants.ROOT_DIR, "data", "raw"))
+def read_station(filename, start_time=None, end_time=None, max_samples=None):
+    """Read the waveform and metadata of a single station from a raw HDF5 file.
+
+    Only the samples in the time window given are read from the file.
+
+    Arguments:
+        filename: Path to the raw file.
+        start_time: Samples before this are dropped, in seconds since the UNIX
+                    epoch. None by default, meaning none are dropped.
+        end_time: Samples after this are dropped, like start_time.
+        max_samples: Largest number of samples read. None by default, meaning
+                     no limit.
+
+    Return:
+        Tuple with the waveform array, its start time in seconds since the UNIX
+        epoch, the time between samples, and the latitude and longitude of the
+        station.
+    """
+    with profiling.stage("hdf5_read"), h5py.File(filename, "r") as file:
+        dataset_name = list(file["waveforms"].keys())[0]
+        waveform = file[f"waveforms/{dataset_name}"]
+
+        starttime_string = waveform.attrs.get("starttime")
+        starttime = unix_time(datetime.strptime(starttime_string,
+                                                "%Y-%m-%dT%H:%M:%S.%fZ"))
+        delta = waveform.attrs.get("delta")
+
+        first, last = 0, len(waveform)
+        if start_time is not None:
+            first = min(last, max(0, int(np.ceil((start_time - starttime)/delta))))
+        if end_time is not None:
+            last = max(first, min(last, int(np.floor((end_time - starttime)/delta)) + 1))
+        if max_samples is not None:
+            last = min(last, first + max_samples)
+        dataset = waveform[first:last]
+        starttime += first*delta
+
+        lat = file.attrs.get("latitude")
+        lon = file.attrs.get("longitude")
+
+    return dataset, starttime, delta, lat, lon
+
+
+# Output array and keys of the existing store, set once in every worker
+# process of the pool
+_worker_outputs = {}
+
+def _open_outputs(data_path, old_keys=()):
+    """Initializer for the worker processes, memory mapping the output array.
+    """
+    _worker_outputs["data"] = np.load(data_path, mmap_mode="r+")
+    _worker_outputs["old_keys"] = set(old_keys)
+
+
+def _ingest_station(task):
+    """Get the key of one raw file, and unless the existing store has it, read
+    the file and write its waveform straight into row i of the memory mapped
+    output array.
+
+    The file is hashed by the worker, so the raw files are hashed in parallel,
+    and read again right after while they are still cached by the OS.
+
+    Arguments:
+        task: Tuple with the row index i, the path to the raw file, the digest
+              of the processing parameters, the coordinates of the source, and
+              the start and end of the time window to read.
+
+    Return:
+        Tuple with i, the key of the station, and None if the key is in the
+        existing store, or else a tuple with the start time, time between
+        samples and number of samples of the waveform, and the latitude,
+        longitude and distance to the source of the station.
+    """
+    i, filename, params, source, start_time, end_time = task
+    data = _worker_outputs["data"]
+
+    with profiling.stage("hashing"):
+        key = cache.digest(cache.file_digest(filename), params)
+    if key in _worker_outputs["old_keys"]:
+        return i, key, None
+
+    dataset, starttime, delta, lat, lon = read_station(filename, start_time, end_time,
+                                                       data.shape[1])
+    data[i][:len(dataset)] = dataset
+
+    with profiling.stage("haversine"):
+        dist = distance(source, (lat, lon))
+    return i, key, (starttime, delta, len(dataset), lat, lon, dist)
+
+
+def process_data(workers=1, raw_dir=None, processed_dir=None, dtype=float,
+                 n_samples=N_SAMPLES, source=None, start_time=None, end_time=None):
+    """Read all the raw station files, and save them in a processed data store.
+
+    The waveforms are written row by row into a memory mapped array on disk,
+    so only a few stations are held in memory at once. With more than one
+    worker, the raw files are hashed and read by a pool of processes that each
+    write their rows directly into this array. Instead of the times of every
+    sample, only the start time, time between samples and number of samples
+    of each station is saved, see time_axis.TimeAxis. Every field is saved as
+    its own .npy file, see storage.ProcessedStore.
+
+    Every station gets a key from the contents of its raw file and the
+    processing parameters. Stations with the same key as in the existing store
+    are copied from it, instead of read from their raw file again.
+
+    Arguments:
+        workers: Number of processes reading raw files. 1 by default, meaning
+                 everything is done in this process.
+        raw_dir: Directory with the raw HDF5 files. data/raw by default.
+        processed_dir: Directory of the processed data store.
+                       constants.PROCESSED_DIR by default.
+        dtype: Data type the waveforms are stored as. float by default, but
+               np.float32 halves the size of the processed data.
+        n_samples: Length every waveform is padded or cut to. N_SAMPLES by
+                   default.
+        source: Tuple with the latitude and longitude the distances of the
+                stations are measured from. constants.TONGA_COORDINATES by
+                default.
+        start_time: Samples before this are dropped, in seconds since the UNIX
+                    epoch. None by default, meaning none are dropped.
+        end_time: Samples after this are dropped, like start_time.
+    """
+    if raw_dir is None:
+        raw_dir = os.path.join(constants.ROOT_DIR, "data", "raw")
+    if source is None:
+        source = constants.TONGA_COORDINATES
+
+    raw_filenames = get_filenames(raw_dir)
+    n_stations = len(raw_filenames)
+
+    params = cache.digest(n_samples=n_samples, dtype=np.dtype(dtype).str,
+                          source=source, start_time=start_time, end_time=end_time)
+
+    store = storage.ProcessedStore(processed_dir)
+    old_rows, old = {}, {}
+    if "keys" in store and "data" in store:
+        old_rows = {key: i for i, key in enumerate(store["keys"])}
+        old = {field: np.array(store[field]) for field in METADATA_FIELDS}
+        # Keep the old waveforms around while the new ones are written, and
+        # remove the keys first, so a crash never leaves mismatching keys
+        old_data_path = os.path.join(store.path, "data.old.npy")
+        os.replace(store.field_path("data"), old_data_path)
+        store.remove("keys")
+    data_path = store.create("data", (n_stations, n_samples), dtype)
+
+    metadata = {field: np.zeros(n_stations, dtype=int if field == "lengths" else float)
+                for field in METADATA_FIELDS}
 
-    data = np.zeros((len(raw_filenames), 720000), dtype=float)
-    times = np.zeros_like(data)
-    lats = np.zeros(len(raw_filenames), dtype=float)
-    lons = np.zeros_like(lats)
-    distances = np.zeros_like(lats)
+    tasks = [(i, filename, params, source, start_time, end_time)
+             for i, filename in enumerate(raw_filenames)]
+    if workers > 1:
+        with ProcessPoolExecutor(workers, initializer=_open_outputs,
+                                 initargs=(data_path, list(old_rows))) as executor:
+            results = list(executor.map(_ingest_station, tasks, chunksize=4))
+    else:
+        _open_outputs(data_path, old_rows)
+        results = [_ingest_station(task) for task in tasks]
+    _worker_outputs.clear()
 
-    for i, filename in enumerate(raw_filenames):
-        with h5py.File(filename, "r") as file:
-            dataset_name = list(file["waveforms"].keys())[0]
-            dataset = file[f"waveforms/{dataset_name}"][:]
-            data[i][:len(dataset)] = dataset
+    keys = np.array([key for _, key, _ in results])
+    for i, _, values in results:
+        if values is not None:
+            for field, value in zip(METADATA_FIELDS, values):
+                metadata[field][i] = value
 
-            starttime_string = file[f"waveforms/{dataset_name}"].attrs.get("starttime")
-            starttime = unix_time(datetime.strptime(starttime_string,
-                                                    "%Y-%m-%dT%H:%M:%S.%fZ"))
-            delta = file[f"waveforms/{dataset_name}"].attrs.get("delta")
-            deltas = np.linspace(0, delta*len(dataset), len(dataset))
-            times[i][:len(dataset)] = starttime + deltas
+    reused = [(i, old_rows[key]) for i, key, values in results if values is None]
+    if reused:
+        old_data = np.load(old_data_path, mmap_mode="r")
+        data = np.load(data_path, mmap_mode="r+")
+        for i, j in reused:
+            data[i] = old_data[j]
+            for field in METADATA_FIELDS:
+                metadata[field][i] = old[field][j]
+        data.flush()
+        del old_data, data
+    if old_rows:
+        os.remove(old_data_path)
 
-            lats[i] = file.attrs.get("latitude")
-            lons[i] = file.attrs.get("longitude")
-            distances[i] = distance(constants.TONGA_COORDINATES,
-                                    (lats[i], lons[i]))
+    cache.stats.hit("parse_data", len(reused))
+    cache.stats.miss("parse_data", len(results) - len(reused))
 
-    np.savez(os.path.join(constants.ROOT_DIR, "data", "processed", "processed.npz"),
-             data=data, times=times, lats=lats, lons=lons, distances=distances)
+    with profiling.stage("file_save"):
+        store.save(n_samples=n_samples, **metadata)
+        # Saved last, marking the store as complete
+        store.save(keys=keys)
+
+def filter_signals(h_list, processed_dir=None, filtered_dir=None, block_size=8,
+                   decimation=1, exclude=None):
+    """Filter the signals of all stations with several filters, and save them
+    in a filtered data store.
+
+    Stations whose processed data and filters are unchanged since the last
+    run are reused, see storage.FilteredStore.open_for_writing.
+
+    Arguments:
+        h_list: List of arrays representing the FIRs of the filters.
+        processed_dir: Directory of the processed data store.
+                       constants.PROCESSED_DIR by default.
+        filtered_dir: Directory of the filtered data store.
+                      constants.FILTERED_DIR by default.
+        block_size: Number of stations filtered at once, keeping the memory
+                    usage bounded. 8 by default.
+        decimation: Factor to decimate the filtered signals by, see
+                    signal_processing.decimate. 1 by default, meaning no
+                    decimation.
+        exclude: Boolean array telling which stations to leave out, e.g. from
+                 quality.excluded_stations. Their filtered signals are left as
+                 zeros. None by default, meaning no stations are left out.
+    """
+    processed_data = storage.ProcessedStore(processed_dir)
+    data = processed_data["data"]
+    filters_key = cache.digest(filters=h_list, decimation=decimation)
+    if exclude is None:
+        exclude = np.zeros(len(data), dtype=bool)
+    keys = [cache.digest(key, filters_key, excluded=bool(excluded))
+            for key, excluded in zip(processed_data["keys"], exclude)]
+    filtered = storage.FilteredStore.open_for_writing(h_list, keys,
+                                                      -(-data.shape[1] // decimation),
+                                                      path=filtered_dir,
+                                                      decimation=decimation)
+    completed = filtered.completed
+    for start in range(0, len(data), block_size):
+        if np.all(completed[start:start + block_size]):
+            continue
+        stop = min(start + block_size, len(data))
+        y = np.zeros((len(h_list), stop - start, filtered.shape[2]))
+        included = np.flatnonzero(~exclude[start:stop])
+        if len(included):
+            with profiling.stage("convolution"):
+                y_included = signal_processing.filter_bank(data[start + included], h_list)
+            with profiling.stage("decimation"):
+                y[:, included] = signal_processing.decimate(y_included, decimation)
+        with profiling.stage("file_save"):
+            filtered.write(start, y)
 
 if __name__ == "__main__":
     process_data()
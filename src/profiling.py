@@ -0,0 +1,192 @@
+"""Instrumentation of the time and resources used by the stages of the
+pipeline, saved in the Chrome trace format.
+
+The trace can be opened in chrome://tracing or https://ui.perfetto.dev, or
+compared between runs as JSON. Stages nest, so an action shows up with its
+sub-steps, like reading HDF5 files or rendering plots, below it.
+"""
+import os
+import sys
+import json
+import time
+import cProfile
+import resource
+import threading
+import contextlib
+
+
+def _io_counters():
+    """Get the bytes read and written by this process from storage, or None if
+    it is unknown, like on other systems than Linux.
+    """
+    try:
+        with open("/proc/self/io") as file:
+            counters = dict(line.split(": ") for line in file.read().splitlines())
+        return int(counters["read_bytes"]), int(counters["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def max_rss():
+    """Get the peak resident set size of this process so far, in bytes.
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux, and bytes on macOS
+    return max_rss if sys.platform == "darwin" else max_rss*1024
+
+
+def _peak_rss():
+    """Get the peak resident set size of this process since it was last reset
+    with _reset_peak_rss, in bytes, or None if it is unknown, like on other
+    systems than Linux.
+    """
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])*1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    """Reset the peak resident set size of this process to the current one.
+
+    Return:
+        True if it was reset, which only works on Linux.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class Profiler:
+    """Records the wall time, CPU time, peak memory and I/O of stages.
+
+    On Linux the peak resident set size of the process is reset when a stage
+    starts, so "peak_rss_bytes" is the peak during the stage. Elsewhere only
+    the peak of the process so far is known, which is recorded as
+    "process_peak_rss_so_far_bytes" instead, and includes what stages before
+    used.
+
+    Arguments:
+        filename: Path to save the trace to. None by default, meaning nothing
+                  is recorded.
+        cprofile_stage: Name of a stage to also run cProfile on. Its stats are
+                        saved next to the trace, as <filename>.<stage>.prof.
+                        None by default.
+    """
+    def __init__(self, filename=None, cprofile_stage=None):
+        self.filename = filename
+        self.cprofile_stage = cprofile_stage
+        self.events = []
+        self._start = time.perf_counter()
+        # Peak resident set size of every open stage, from before the last
+        # reset of the peak of the process
+        self._peaks = []
+
+    @property
+    def enabled(self):
+        return self.filename is not None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager recording everything done inside it as a stage.
+
+        Arguments:
+            name: Name of the stage.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        profile = cProfile.Profile() if name == self.cprofile_stage else None
+        # The peak so far belongs to the stages this one is inside
+        peak = _peak_rss()
+        if peak is not None:
+            self._peaks = [max(outer, peak) for outer in self._peaks]
+        resettable = peak is not None and _reset_peak_rss()
+        self._peaks.append(0)
+        io_before = _io_counters()
+        cpu, wall = time.process_time(), time.perf_counter()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                profile.dump_stats(f"{self.filename}.{name}.prof")
+            wall_end, cpu_end = time.perf_counter(), time.process_time()
+            io_after = _io_counters()
+
+            peak = max(self._peaks.pop(), _peak_rss() or 0)
+            # The stages this one is inside reached at least the same peak
+            self._peaks = [max(outer, peak) for outer in self._peaks]
+
+            args = {"cpu_seconds": cpu_end - cpu}
+            if resettable:
+                args["peak_rss_bytes"] = peak
+            else:
+                args["process_peak_rss_so_far_bytes"] = max_rss()
+            if io_before is not None and io_after is not None:
+                args["read_bytes"] = io_after[0] - io_before[0]
+                args["written_bytes"] = io_after[1] - io_before[1]
+            self.events.append({"name": name, "ph": "X", "pid": os.getpid(),
+                                "tid": threading.get_ident(),
+                                "ts": (wall - self._start)*1e6,
+                                "dur": (wall_end - wall)*1e6, "args": args})
+
+    def export(self):
+        """Get the recorded stages, to be merged into the profiler of another
+        process with merge.
+        """
+        return {"start": self._start, "events": self.events}
+
+    def merge(self, exported):
+        """Add the stages recorded by the profiler of another process.
+
+        Arguments:
+            exported: Output of export from the other profiler. Its times are
+                      shifted to this profiler's, which relies on
+                      time.perf_counter being shared between processes, like
+                      on Linux and macOS.
+        """
+        shift = (exported["start"] - self._start)*1e6
+        self.events.extend(dict(event, ts=event["ts"] + shift)
+                           for event in exported["events"])
+
+    def save(self):
+        """Save the recorded stages as a Chrome trace, if enabled.
+        """
+        if self.enabled:
+            with open(self.filename, "w") as file:
+                json.dump({"traceEvents": self.events,
+                           "displayTimeUnit": "ms"}, file, indent=1)
+
+
+# Profiler of this process, enabled by the IN3190_PROFILE environment variable
+# or by main.py with --profile
+profiler = Profiler(os.environ.get("IN3190_PROFILE"),
+                    os.environ.get("IN3190_CPROFILE"))
+
+
+def enable(filename, cprofile_stage=None):
+    """Start recording stages to a trace file.
+
+    Arguments:
+        filename: Path to save the trace to.
+        cprofile_stage: Name of a stage to also run cProfile on. None by default.
+    """
+    profiler.filename = filename
+    profiler.cprofile_stage = cprofile_stage
+
+
+def stage(name):
+    """Record a stage with the profiler of this process, see Profiler.stage.
+    """
+    return profiler.stage(name)
@@ -0,0 +1,184 @@
+"""Quality control of the stations, from the power spectra of their waveforms.
+
+Stations whose waveforms are flat, much louder or quieter than the rest of
+the network, or have gaps, are flagged in one pass over the processed data,
+so they can be left out of filtering and picking.
+"""
+import numpy as np
+
+import cache
+import profiling
+import signal_processing
+import storage
+
+
+def station_spectra(x, steps, lengths, nperseg=1024, noverlap=None):
+    """Get Welch's estimate of the power spectral density of a block of
+    stations, and the power of every segment it is averaged over.
+
+    Only segments completely inside the valid samples of a station are used,
+    so the zero padding after them doesn't lower the estimate.
+
+    Arguments:
+        x: 2-d array with the signal of every station.
+        steps: Array with the time between samples of every station, e.g.
+               time_axis.TimeAxis.steps.
+        lengths: Integer array with the number of valid samples of every
+                 station.
+        nperseg: Number of samples in every segment. 1024 by default.
+        noverlap: Number of samples shared by consecutive segments. None by
+                  default, meaning nperseg//2.
+
+    Return:
+        2-d arrays with the power spectral density of every station in units
+        squared per Hz, and the frequencies in Hz it is given at, and a 2-d
+        array with the mean square of every segment, which is NaN for segments
+        outside the valid samples.
+    """
+    if noverlap is None:
+        noverlap = nperseg//2
+    spectra = signal_processing.spectrogram(x, nperseg, noverlap)
+
+    starts = np.arange(spectra.shape[-2])*(nperseg - noverlap)
+    valid = starts[np.newaxis, :] + nperseg <= np.asarray(lengths)[:, np.newaxis]
+    n_valid = np.maximum(np.sum(valid, axis=1), 1)[:, np.newaxis]
+    steps = np.asarray(steps, dtype=float)[:, np.newaxis]
+
+    psd = np.einsum("sk,skf->sf", valid, spectra)/n_valid*steps
+    frequencies = np.fft.rfftfreq(nperseg)[np.newaxis, :]/steps
+    frame_power = np.where(valid, np.sum(spectra, axis=-1)/nperseg, np.nan)
+    return psd, frequencies, frame_power
+
+
+def quality_flags(psd, frame_power, quiet_db=60, loud_db=20, gap_fraction=0.1):
+    """Flag bad stations from their spectra.
+
+    The noise floor of a station is the median of its power spectral density
+    in dB. Stations are compared with the median noise floor of the network.
+
+    Arguments:
+        psd: 2-d array with the power spectral density of every station, like
+             from station_spectra.
+        frame_power: 2-d array with the power of every segment, like from
+                     station_spectra.
+        quiet_db: Stations this much below the median noise floor, or without
+                  any signal, are flagged as dead. 60 dB by default.
+        loud_db: Stations this much above the median noise floor are flagged
+                 as noisy. 20 dB by default.
+        gap_fraction: Stations where more than this fraction of the segments
+                      have (almost) no power, e.g. from gaps filled with
+                      zeros, are flagged as gappy. 0.1 by default.
+
+    Return:
+        Array with the noise floor of every station in dB, and boolean arrays
+        telling which stations are dead, noisy and gappy.
+    """
+    has_data = np.any(np.isfinite(frame_power), axis=1) & (np.max(psd, axis=1) > 0)
+    log_psd = 10*np.log10(np.where(psd[:, 1:] > 0, psd[:, 1:], np.nan))
+    noise_floor = np.full(len(psd), -np.inf)
+    if np.any(has_data):
+        noise_floor[has_data] = np.nanmedian(log_psd[has_data], axis=1)
+        network_floor = np.median(noise_floor[has_data])
+    else:
+        network_floor = 0
+
+    dead = ~has_data | (noise_floor < network_floor - quiet_db)
+    noisy = ~dead & (noise_floor > network_floor + loud_db)
+
+    typical_power = np.full(len(psd), np.nan)
+    typical_power[has_data] = np.nanmedian(frame_power[has_data], axis=1)
+    with np.errstate(invalid="ignore"):
+        silent = frame_power <= 1e-6*typical_power[:, np.newaxis]
+    n_frames = np.maximum(np.sum(np.isfinite(frame_power), axis=1), 1)
+    gappy = ~dead & (np.sum(silent, axis=1)/n_frames > gap_fraction)
+    return noise_floor, dead, noisy, gappy
+
+
+def quality_control(processed_dir=None, spectra_dir=None, nperseg=1024,
+                    noverlap=None, block_size=8, **flag_args):
+    """Compute the spectra of all stations, and flag the bad ones.
+
+    The spectra are saved in a storage.SpectraStore with a key for every
+    station, made from its processed data and the parameters, and stations
+    with unchanged keys are reused from it. The flags depend on the whole
+    network, so they are always made again.
+
+    Arguments:
+        processed_dir: Directory of the processed data store.
+                       constants.PROCESSED_DIR by default.
+        spectra_dir: Directory of the spectra store. constants.SPECTRA_DIR by
+                     default.
+        nperseg: Number of samples in every segment. 1024 by default.
+        noverlap: Number of samples shared by consecutive segments. None by
+                  default, meaning nperseg//2.
+        block_size: Number of stations processed at once. 8 by default.
+        **flag_args: Arguments passed on to quality_flags.
+
+    Return:
+        Boolean arrays telling which stations are dead, noisy and gappy, see
+        quality_flags.
+    """
+    if noverlap is None:
+        noverlap = nperseg//2
+    processed_data = storage.ProcessedStore(processed_dir)
+    data = processed_data["data"]
+    times = processed_data.times
+    params = cache.digest(nperseg=nperseg, noverlap=noverlap)
+    keys = np.array([cache.digest(key, params) for key in processed_data["keys"]])
+
+    n_frames = (data.shape[1] - noverlap)//(nperseg - noverlap)
+    fields = {"psd": np.zeros((len(keys), nperseg//2 + 1)),
+              "frequencies": np.zeros((len(keys), nperseg//2 + 1)),
+              "frame_power": np.full((len(keys), n_frames), np.nan)}
+
+    store = storage.SpectraStore(spectra_dir)
+    old_rows = {}
+    if "keys" in store:
+        old_rows = {key: i for i, key in enumerate(store["keys"])}
+    reused = [(i, old_rows[key]) for i, key in enumerate(keys) if key in old_rows]
+    for field, values in fields.items():
+        for i, j in reused:
+            values[i] = store[field][j]
+    missing = np.array([i for i, key in enumerate(keys) if key not in old_rows],
+                       dtype=int)
+    cache.stats.hit("quality_control", len(reused))
+    cache.stats.miss("quality_control", len(missing))
+
+    for start in range(0, len(missing), block_size):
+        rows = missing[start:start + block_size]
+        with profiling.stage("spectra"):
+            block = station_spectra(data[rows], times.steps[rows],
+                                    times.lengths[rows], nperseg, noverlap)
+        for values, block_values in zip(fields.values(), block):
+            values[rows] = block_values
+
+    noise_floor, dead, noisy, gappy = quality_flags(fields["psd"], fields["frame_power"],
+                                                    **flag_args)
+    with profiling.stage("file_save"):
+        store.remove("keys")
+        store.save(noise_floor=noise_floor, dead=dead, noisy=noisy, gappy=gappy,
+                   stations=np.array(processed_data["keys"]), **fields)
+        # Saved last, marking the store as complete
+        store.save(keys=keys)
+    return dead, noisy, gappy
+
+
+def excluded_stations(processed_data, spectra_dir=None):
+    """Get the stations flagged by the last quality control of the processed
+    data.
+
+    Arguments:
+        processed_data: storage.ProcessedStore.
+        spectra_dir: Directory of the spectra store. constants.SPECTRA_DIR by
+                     default.
+
+    Return:
+        Boolean array telling which stations are flagged. No stations are
+        flagged if quality control hasn't been run since the processed data
+        last changed.
+    """
+    store = storage.SpectraStore(spectra_dir)
+    keys = processed_data["keys"]
+    if "keys" not in store or not np.array_equal(store["stations"], keys):
+        return np.zeros(len(keys), dtype=bool)
+    return store["dead"] | store["noisy"] | store["gappy"]
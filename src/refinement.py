@@ -0,0 +1,229 @@
+"""Refinement of the arrival times picked at every station, by aligning the
+waveforms of neighbouring stations with cross-correlation.
+
+The picks are made one station at a time, so nearby stations recording the
+same wave can still disagree. Cross-correlating the filtered traces of
+neighbours around their picks measures how much their relative arrival times
+are off, and solving for the shifts that best explain all these measurements
+at once, while staying close to the picks, makes the arrival times
+consistent.
+"""
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+import scipy.signal
+import scipy.spatial
+
+import cache
+import profiling
+import signal_processing
+import storage
+
+# Mean radius of the earth in meters, as used by haversine
+EARTH_RADIUS = 6371008.8
+
+
+def unit_vectors(lats, lons):
+    """Get the positions of points on the earth as 3-d unit vectors.
+
+    Arguments:
+        lats: Array with the latitudes in degrees.
+        lons: Array with the longitudes in degrees.
+
+    Return:
+        Array of shape (n_points, 3).
+    """
+    lats, lons = np.radians(lats), np.radians(lons)
+    return np.stack((np.cos(lats)*np.cos(lons), np.cos(lats)*np.sin(lons),
+                     np.sin(lats)), axis=-1)
+
+
+def neighbour_pairs(lats, lons, n_neighbours=6, max_distance=2e6):
+    """Find the pairs of nearby stations, using a k-d tree of their positions.
+
+    Arguments:
+        lats: Array with the latitudes of the stations in degrees.
+        lons: Array with the longitudes of the stations in degrees.
+        n_neighbours: Number of nearest neighbours of every station. 6 by
+                      default.
+        max_distance: Largest great circle distance between neighbours in
+                      meters. 2000 km by default.
+
+    Return:
+        Integer array of shape (n_pairs, 2), with every pair once and the
+        smallest index first.
+    """
+    points = unit_vectors(lats, lons)
+    n_neighbours = min(n_neighbours, len(points) - 1)
+    if n_neighbours < 1:
+        return np.zeros((0, 2), dtype=int)
+
+    # Chord length of the largest great circle distance
+    max_chord = 2*np.sin(min(max_distance/EARTH_RADIUS, np.pi)/2)
+    chords, neighbours = scipy.spatial.cKDTree(points).query(
+        points, k=n_neighbours + 1, distance_upper_bound=max_chord
+    )
+    stations = np.broadcast_to(np.arange(len(points))[:, np.newaxis],
+                               neighbours.shape)
+    found = np.isfinite(chords) & (neighbours != stations)
+    pairs = np.sort(np.stack((stations[found], neighbours[found]), axis=1), axis=1)
+    return np.unique(pairs, axis=0)
+
+
+def pick_windows(signals, times, arrival_times, window, dt, stations=None):
+    """Resample the signals of stations in a window around their picks, on a
+    common sample spacing.
+
+    Arguments:
+        signals: 2-d array with the filtered signal of every station.
+        times: time_axis.TimeAxis with the times of the signals.
+        arrival_times: Array with the picked arrival time of every station.
+        window: Length of the windows in seconds.
+        dt: Time between the samples of the windows.
+        stations: Indices of the stations to get windows for. None by default,
+                  meaning all stations.
+
+    Return:
+        2-d array with one tapered window of round(window/dt) samples for every
+        station, centered on its pick.
+    """
+    if stations is None:
+        stations = np.arange(len(arrival_times))
+    n = int(round(window/dt))
+    offsets = (np.arange(n) - n//2)*dt
+    steps = times.steps
+    taper = scipy.signal.windows.tukey(n, 0.2)
+
+    windows = np.zeros((len(stations), n), dtype=float)
+    for k, i in enumerate(stations):
+        grid = arrival_times[i] + offsets
+        # Only the samples around the window are read
+        first = max(0, int(np.floor((grid[0] - times.starttimes[i])/steps[i])) - 1)
+        last = min(times.lengths[i], int(np.ceil((grid[-1] - times.starttimes[i])
+                                                 /steps[i])) + 2)
+        if last - first < 2:
+            continue
+        segment_times = times.starttimes[i] + np.arange(first, last)*steps[i]
+        x = np.interp(grid, segment_times, signals[i, first:last], left=0, right=0)
+        windows[k] = (x - x.mean())*taper
+    return windows
+
+
+def solve_shifts(n_stations, pairs, lag_times, weights, anchor_weights):
+    """Find the shifts of the arrival times that best explain the measured
+    relative shifts between pairs of stations.
+
+    Solves the sparse weighted least squares problem with one equation
+    shift[i] - shift[j] = lag_time for every pair, and shift[i] = 0 for every
+    station, tying the arrival times to the picks.
+
+    Arguments:
+        n_stations: Number of stations.
+        pairs: Integer array of shape (n_pairs, 2).
+        lag_times: Array with the measured shift between every pair in seconds.
+        weights: Array with the weight of every pair.
+        anchor_weights: Array with the weight of keeping every station at its
+                        pick. Must be positive for the problem to have a unique
+                        solution.
+
+    Return:
+        Array with the shift of every station in seconds.
+    """
+    n_pairs = len(pairs)
+    rows = np.concatenate((np.repeat(np.arange(n_pairs), 2),
+                           n_pairs + np.arange(n_stations)))
+    columns = np.concatenate((pairs.ravel(), np.arange(n_stations)))
+    values = np.concatenate((np.stack((weights, -weights), axis=1).ravel(),
+                             anchor_weights))
+    A = scipy.sparse.csr_matrix((values, (rows, columns)),
+                                shape=(n_pairs + n_stations, n_stations))
+    b = np.concatenate((weights*lag_times, np.zeros(n_stations)))
+    return scipy.sparse.linalg.lsqr(A, b, atol=1e-10, btol=1e-10)[0]
+
+
+def refine_arrival_times(signals, times, lats, lons, arrival_times, weights,
+                         keys=None, window=1800, max_shift=300, n_neighbours=6,
+                         max_distance=2e6, min_coefficient=0.5, anchor_weight=0.1,
+                         path=None):
+    """Refine the arrival times of the wave with cross-correlations between
+    the signals of neighbouring stations.
+
+    Stations whose weight is 0 are left as they are, and not used to refine
+    the others.
+
+    Arguments:
+        signals: 2-d array with the filtered signal of every station, e.g.
+                 one filter of a storage.FilteredStore.
+        times: time_axis.TimeAxis with the times of the signals.
+        lats: Array with the latitudes of the stations in degrees.
+        lons: Array with the longitudes of the stations in degrees.
+        arrival_times: Array with the picked arrival time of every station.
+        weights: Array with the weight between 0 and 1 of every pick, e.g.
+                 from picking.validness_to_weights.
+        keys: Sequence of strings identifying the signal of every station,
+              e.g. the keys of a storage.FilteredStore, used to cache the
+              cross-correlations. None by default, meaning nothing is cached.
+        window: Length of the windows correlated around the picks in seconds.
+                1800 by default.
+        max_shift: Largest relative shift between two stations in seconds.
+                   300 by default.
+        n_neighbours: Number of neighbours of every station. 6 by default.
+        max_distance: Largest distance between neighbours in meters. 2000 km
+                      by default.
+        min_coefficient: Pairs correlating less than this are ignored. 0.5 by
+                         default.
+        anchor_weight: Weight of keeping a station with weight 1 at its pick,
+                       relative to a pair with a correlation coefficient of 1.
+                       0.1 by default.
+        path: Directory of the storage.CorrelationStore caching the
+              cross-correlations. constants.CORRELATIONS_DIR by default.
+
+    Return:
+        Array with the refined arrival times.
+    """
+    arrival_times = np.asarray(arrival_times, dtype=float)
+    used = np.flatnonzero(np.asarray(weights) > 0)
+    if len(used) < 2:
+        return arrival_times.copy()
+
+    # All windows are resampled to the coarsest sampling of the stations
+    dt = np.max(times.steps[used])
+    pairs = neighbour_pairs(np.asarray(lats)[used], np.asarray(lons)[used],
+                            n_neighbours, max_distance)
+
+    with profiling.stage("cross_correlation"):
+        if keys is None:
+            found = np.zeros(len(pairs), dtype=bool)
+            lags, coefficients = np.zeros((2, len(pairs)))
+        else:
+            params = cache.digest(window=window, max_shift=max_shift, dt=dt)
+            pair_keys = [cache.digest(str(keys[used[i]]), str(keys[used[j]]), params,
+                                      arrival_times=arrival_times[used[[i, j]]])
+                         for i, j in pairs]
+            correlations = storage.CorrelationStore(path)
+            found, lags, coefficients = correlations.lookup(pair_keys)
+            cache.stats.hit("cross_correlation", int(np.sum(found)))
+            cache.stats.miss("cross_correlation", int(np.sum(~found)))
+
+        missing = pairs[~found]
+        if len(missing):
+            # Only the windows of stations in a missing pair are needed
+            stations = np.unique(missing)
+            windows = np.zeros((len(used), int(round(window/dt))), dtype=float)
+            windows[stations] = pick_windows(signals, times, arrival_times,
+                                             window, dt, used[stations])
+            lags[~found], coefficients[~found] = signal_processing.cross_correlation_peaks(
+                windows, missing, int(np.ceil(max_shift/dt))
+            )
+        if keys is not None:
+            correlations.save(pair_keys, lags, coefficients)
+
+    with profiling.stage("shift_inversion"):
+        good = coefficients >= min_coefficient
+        shifts = solve_shifts(len(used), pairs[good], lags[good]*dt,
+                              coefficients[good],
+                              anchor_weight*np.asarray(weights)[used])
+
+    refined = arrival_times.copy()
+    refined[used] += shifts
+    return refined
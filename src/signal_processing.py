@@ -1,6 +1,8 @@
 """Different mathematical operations done to signals.
 """
 import numpy as np
+import scipy.fft as sp_fft
+from numpy.lib.stride_tricks import sliding_window_view
 
 def convolution(x, h, ylen_choice=True):
     """Perform a convolution operation with a filter h and a signal x.
@@ -27,10 +29,333 @@ def dtft(x, N=None, fs=1):
         fs: The sampling frequency. 1 by default.
 
     Return:
-        The complex valued array X(exp(j*omega)), and a tuple with a frequency 
-        array and the real valued array with with amplitude for that frequency
+        The complex valued array X(exp(j*omega)), and a tuple with the
+        frequencies from 0 to fs/2 of the non-negative half of the spectrum,
+        and the complex valued array with X at those frequencies.
     """
     if N is None:
         N = len(x)
 
-    return np.fft.fft(x, N), (fs*np.arange(N)[::2], np.fft.rfft(x, N))
+    return np.fft.fft(x, N), (np.fft.rfftfreq(N, d=1/fs), np.fft.rfft(x, N))
+
+
+# Spectra of filters, keyed on the filter coefficients and FFT length
+_spectrum_cache = {}
+
+def filter_spectrum(h, nfft):
+    """Get the real FFT of a filter zero padded to length nfft, cached so it is
+    only computed once for every FFT length.
+
+    Arguments:
+        h: An array representing the FIR of a filter.
+        nfft: Length of the FFT.
+
+    Return:
+        Complex array of length nfft//2 + 1.
+    """
+    h = np.asarray(h, dtype=float)
+    key = (h.tobytes(), nfft)
+    if key not in _spectrum_cache:
+        _spectrum_cache[key] = sp_fft.rfft(h, nfft)
+    return _spectrum_cache[key]
+
+
+# Filters up to this long are applied directly by filter_bank, longer ones
+# with FFTs. Measured on one core with 53 tap filters, the direct product is
+# about 1.3 times faster than np.convolve, and FFTs only win above 150 taps
+DIRECT_MAX_TAPS = 128
+
+
+def direct_filter_bank(x, h_list, block_len=64):
+    """Filter a block of signals with several short FIR filters, as matrix
+    products.
+
+    The signals are cut into blocks of block_len samples, each with the
+    samples around it the filters reach. Sample k of every filtered block is
+    then the product of these windows with column k of a banded Toeplitz
+    matrix of the filter, so each filter is applied to all blocks of all
+    signals with one BLAS matrix product. The result is equal to
+    convolution(x[i], h_list[j], ylen_choice=False) for every signal i and
+    filter j, up to floating point error.
+
+    Arguments:
+        x: 2-d array with one signal in every row. A 1-d array is treated as a
+           single signal.
+        h_list: List of arrays representing the FIRs of the filters.
+        block_len: Number of samples in every block. 64 by default, which
+                   was fastest for filters of 53 taps.
+
+    Return:
+        3-d array y where y[j, i] is signal i filtered by filter j.
+    """
+    x = np.atleast_2d(x)
+    n_signals, n = x.shape
+    # Samples after and before the output sample the filters reach
+    lookahead = max((len(h) - 1)//2 for h in h_list)
+    lookback = max(len(h) - 1 - (len(h) - 1)//2 for h in h_list)
+    window_len = block_len + lookback + lookahead
+    n_blocks = -(-n // block_len)
+
+    padded = np.zeros((n_signals, n_blocks*block_len + lookback + lookahead),
+                      dtype=float)
+    padded[:, lookback:lookback + n] = x
+    windows = np.ascontiguousarray(
+        sliding_window_view(padded, window_len, axis=1)[:, ::block_len]
+    )
+    del padded
+
+    y = np.empty((len(h_list), n_signals, n_blocks*block_len), dtype=float)
+    samples = np.arange(block_len)
+    for j, h in enumerate(h_list):
+        # Same alignment as np.convolve with mode="same"
+        offset = (len(h) - 1)//2
+        matrix = np.zeros((window_len, block_len), dtype=float)
+        for t, coefficient in enumerate(h):
+            matrix[samples + lookback + offset - t, samples] = coefficient
+        # Written straight into the output, which has the same memory layout
+        np.matmul(windows, matrix, out=y[j].reshape(n_signals, n_blocks, block_len))
+    return y[..., :n]
+
+
+def filter_bank(x, h_list, nfft=None, workers=-1, method=None):
+    """Filter a block of signals with several FIR filters in one pass.
+
+    Short filters are applied with direct_filter_bank. Longer ones use
+    overlap-add FFT convolution: the signals are split into segments, which
+    are all transformed in one batched FFT, multiplied by the spectrum of each
+    filter, transformed back and added together again. The result is equal to
+    convolution(x[i], h_list[j], ylen_choice=False) for every signal i and
+    filter j, up to floating point error.
+
+    Arguments:
+        x: 2-d array with one signal in every row. A 1-d array is treated as a
+           single signal.
+        h_list: List of arrays representing the FIRs of the filters.
+        nfft: Length of the FFTs. None by default, meaning a fast length of
+              at least 1024 and eight times the longest filter is used.
+        workers: Number of threads scipy.fft uses for the FFTs. -1 by default,
+                 meaning all cores are used.
+        method: Either "direct" or "fft". None by default, meaning "direct"
+                for filters of at most DIRECT_MAX_TAPS taps, and "fft" for
+                longer ones.
+
+    Return:
+        3-d array y where y[j, i] is signal i filtered by filter j.
+    """
+    x = np.atleast_2d(x)
+    n_signals, n = x.shape
+    m = max(len(h) for h in h_list)
+
+    if n < m:
+        # numpy returns the length of the filter in this case, so fall back
+        return np.array([[convolution(_x, h, ylen_choice=False) for _x in x]
+                         for h in h_list])
+
+    if method is None:
+        method = "direct" if m <= DIRECT_MAX_TAPS else "fft"
+    if method == "direct":
+        return direct_filter_bank(x, h_list)
+    if method != "fft":
+        raise ValueError(f"method must be 'direct' or 'fft', got {method!r}.")
+
+    if nfft is None:
+        nfft = sp_fft.next_fast_len(max(1024, 8*m), real=True)
+    if nfft < 2*m:
+        raise ValueError(f"nfft must be at least twice the length of the "\
+                         f"longest filter ({2*m}), got {nfft}.")
+    segment_len = nfft - m + 1
+    n_segments = -(-n // segment_len)
+
+    segments = np.zeros((n_signals, n_segments*segment_len), dtype=float)
+    segments[:, :n] = x
+    segments = segments.reshape(n_signals, n_segments, segment_len)
+    X = sp_fft.rfft(segments, nfft, axis=-1, workers=workers)
+    del segments
+
+    y = np.empty((len(h_list), n_signals, n), dtype=float)
+    full = np.empty((n_signals, n_segments + 1, segment_len), dtype=float)
+    for j, h in enumerate(h_list):
+        y_segments = sp_fft.irfft(X*filter_spectrum(h, nfft), nfft, axis=-1,
+                                  workers=workers)
+        full[:, :-1] = y_segments[..., :segment_len]
+        full[:, -1] = 0
+        # The last m - 1 samples of each segment overlap the next one
+        full[:, 1:, :m - 1] += y_segments[..., segment_len:]
+
+        offset = (len(h) - 1)//2
+        y[j] = full.reshape(n_signals, -1)[:, offset:offset + n]
+
+    return y
+
+
+def sta_lta(x, n_sta, n_lta):
+    """Ratio between short and long term averages of the energy of signals.
+
+    The short term average at a sample is over the window starting there, and
+    the long term average over the window just before it, so the ratio peaks
+    at the onset of a rise in energy. Both are computed for all signals at once
+    from one cumulative sum. Samples without full windows on both sides are
+    set to 0.
+
+    Arguments:
+        x: 2-d array with one signal in every row.
+        n_sta: Length of the short term window in samples. Either an integer,
+               or an array with one length for each signal.
+        n_lta: Length of the long term window in samples, like n_sta.
+
+    Return:
+        2-d array with the same shape as x.
+    """
+    x = np.atleast_2d(x)
+    n_signals, n = x.shape
+    n_sta = np.broadcast_to(np.asarray(n_sta, dtype=int), (n_signals,))[:, np.newaxis]
+    n_lta = np.broadcast_to(np.asarray(n_lta, dtype=int), (n_signals,))[:, np.newaxis]
+
+    energy = np.zeros((n_signals, n + 1), dtype=float)
+    np.cumsum(np.square(x, dtype=float), axis=1, out=energy[:, 1:])
+
+    samples = np.arange(n)[np.newaxis, :]
+    before = energy[:, :-1]
+    sta = (np.take_along_axis(energy, np.minimum(samples + n_sta, n), axis=1) - before)/n_sta
+    lta = (before - np.take_along_axis(energy, np.maximum(samples - n_lta, 0), axis=1))/n_lta
+
+    ratio = np.divide(sta, lta, out=np.zeros_like(sta), where=lta > 0)
+    ratio[(samples < n_lta) | (samples + n_sta > n)] = 0
+    return ratio
+
+
+def minmax_envelope(x, factor):
+    """Downsample signals by keeping the minimum and maximum of every bin of
+    samples, which preserves the peaks when plotting them.
+
+    Arguments:
+        x: Array with signals along the last axis.
+        factor: Number of samples in every bin. The last bin is shorter if
+                the length of the signals isn't divisible by it.
+
+    Return:
+        Two arrays, with the minimum and maximum of every bin.
+    """
+    x = np.asarray(x)
+    n = x.shape[-1]
+    n_bins = -(-n // factor)
+    pad = n_bins*factor - n
+    if pad:
+        # Repeating the last sample doesn't change the extremes of the bin
+        x = np.concatenate((x, np.repeat(x[..., -1:], pad, axis=-1)), axis=-1)
+    x = x.reshape(x.shape[:-1] + (n_bins, factor))
+    return x.min(axis=-1), x.max(axis=-1)
+
+
+def decimate(x, factor):
+    """Reduce the sample rate of signals by an integer factor.
+
+    Uses a polyphase implementation of an anti-aliasing lowpass filter
+    followed by downsampling, so only the kept samples are computed. Sample k
+    of the output corresponds to sample k*factor of the input.
+
+    Arguments:
+        x: Array with signals along the last axis.
+        factor: Integer decimation factor. 1 returns x as it is.
+
+    Return:
+        Array with ceil(len/factor) samples along the last axis.
+    """
+    if factor == 1:
+        return x
+    # scipy.signal takes long to import, so it is only imported when needed
+    import scipy.signal
+    return scipy.signal.resample_poly(x, 1, factor, axis=-1)
+
+
+def cross_correlation_peaks(windows, pairs, max_lag, block_size=1024, workers=-1):
+    """Find the lag of best alignment between pairs of equally long signals.
+
+    Every signal is transformed once, and the normalized cross-correlations
+    of blocks of pairs are computed in one batched inverse FFT. The peak is
+    refined to a fraction of a sample with a parabola through it and its
+    neighbours.
+
+    Arguments:
+        windows: 2-d array with one signal in every row.
+        pairs: Integer array of shape (n_pairs, 2) with the rows to correlate.
+        max_lag: Largest lag searched, in samples.
+        block_size: Number of pairs correlated at once. 1024 by default.
+        workers: Number of threads scipy.fft uses for the FFTs. -1 by default,
+                 meaning all cores are used.
+
+    Return:
+        Arrays with the lag and the correlation coefficient between -1 and 1
+        of every pair. A positive lag means windows[i] lags windows[j], i.e.
+        windows[i][k + lag] best matches windows[j][k].
+    """
+    windows = np.atleast_2d(np.asarray(windows, dtype=float))
+    pairs = np.asarray(pairs, dtype=int).reshape(-1, 2)
+    n = windows.shape[1]
+    max_lag = min(int(max_lag), n - 1)
+    nfft = sp_fft.next_fast_len(2*n - 1, real=True)
+
+    norms = np.linalg.norm(windows, axis=1)
+    X = sp_fft.rfft(windows/np.where(norms > 0, norms, 1)[:, np.newaxis], nfft,
+                    axis=-1, workers=workers)
+
+    lags = np.zeros(len(pairs), dtype=float)
+    coefficients = np.zeros(len(pairs), dtype=float)
+    for start in range(0, len(pairs), block_size):
+        i, j = pairs[start:start + block_size].T
+        cc = sp_fft.irfft(X[i]*np.conj(X[j]), nfft, axis=-1, workers=workers)
+        # Reorder the circular lags to go from -max_lag to max_lag
+        cc = np.concatenate((cc[:, nfft - max_lag:], cc[:, :max_lag + 1]), axis=1)
+
+        peaks = np.argmax(cc, axis=1)
+        rows = np.arange(len(peaks))
+        peak = cc[rows, peaks]
+        before = cc[rows, np.maximum(peaks - 1, 0)]
+        after = cc[rows, np.minimum(peaks + 1, 2*max_lag)]
+        curvature = before - 2*peak + after
+        interior = (peaks > 0) & (peaks < 2*max_lag) & (curvature < 0)
+        offset = np.divide(before - after, 2*curvature, out=np.zeros_like(peak),
+                           where=interior)
+
+        lags[start:start + block_size] = peaks - max_lag + offset
+        coefficients[start:start + block_size] = peak
+    return lags, coefficients
+
+
+def spectrogram(x, nperseg=1024, noverlap=None, workers=-1):
+    """Power spectra of overlapping segments of signals, for all signals and
+    segments in one batched FFT.
+
+    Every segment has its mean removed and is multiplied by a Hann window,
+    like in scipy.signal.spectrogram. Averaging the spectra over the segments
+    gives Welch's estimate of the power spectral density.
+
+    Arguments:
+        x: Array with signals along the last axis.
+        nperseg: Number of samples in every segment. 1024 by default.
+        noverlap: Number of samples shared by consecutive segments. None by
+                  default, meaning nperseg//2.
+        workers: Number of threads scipy.fft uses for the FFTs. -1 by default,
+                 meaning all cores are used.
+
+    Return:
+        Array with the one-sided power spectral density of every segment, per
+        unit of normalized frequency, indexed like x but with the last axis
+        replaced by (segment, frequency). Segment k starts at sample
+        k*(nperseg - noverlap), and frequency bin m is at m/nperseg cycles per
+        sample, so the frequencies in Hz are
+        np.fft.rfftfreq(nperseg, d=1/fs).
+    """
+    if noverlap is None:
+        noverlap = nperseg//2
+    x = np.asarray(x, dtype=float)
+    segments = np.lib.stride_tricks.sliding_window_view(x, nperseg, axis=-1)
+    segments = segments[..., ::nperseg - noverlap, :]
+
+    window = np.hanning(nperseg + 1)[:-1]
+    X = sp_fft.rfft((segments - segments.mean(axis=-1, keepdims=True))*window,
+                    axis=-1, workers=workers)
+    power = np.square(np.abs(X))/np.sum(window**2)
+    # The negative frequencies are folded onto the positive ones
+    power[..., 1:(nperseg + 1)//2] *= 2
+    return power
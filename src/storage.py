@@ -0,0 +1,502 @@
+"""On-disk stores for the processed data, which can be memory mapped.
+"""
+import os
+import json
+
+import numpy as np
+
+import cache
+import constants
+import signal_processing
+from time_axis import TimeAxis
+
+
+class ProcessedStore:
+    """Directory with one uncompressed .npy file for each field of the
+    processed data.
+
+    Fields are opened lazily the first time they are indexed, and memory
+    mapped, so only the fields and rows an action actually uses are read from
+    disk. Indexing works like on the npz-file previously used, e.g.
+    store["distances"].
+
+    Arguments:
+        path: Directory of the store. constants.PROCESSED_DIR by default.
+        mmap_mode: Mode the fields are memory mapped with. 'r' by default. If
+                   None, fields are read fully into memory.
+    """
+    FIELDS = ("data", "starttimes", "deltas", "lengths", "n_samples",
+              "lats", "lons", "distances", "keys")
+
+    def __init__(self, path=None, mmap_mode="r"):
+        self.path = constants.PROCESSED_DIR if path is None else path
+        self.mmap_mode = mmap_mode
+        self._fields = {}
+
+    def field_path(self, field):
+        return os.path.join(self.path, f"{field}.npy")
+
+    def __contains__(self, field):
+        return os.path.exists(self.field_path(field))
+
+    def __getitem__(self, field):
+        if field not in self._fields:
+            if field not in self:
+                raise KeyError(f"{field} is not in the processed data store "\
+                               f"at {self.path}")
+            self._fields[field] = np.load(self.field_path(field),
+                                          mmap_mode=self.mmap_mode)
+        return self._fields[field]
+
+    @property
+    def times(self):
+        """time_axis.TimeAxis with the times of all the measurements."""
+        return TimeAxis.from_processed(self)
+
+    def create(self, field, shape, dtype=float):
+        """Make a zero filled field on disk, without holding it in memory.
+
+        Arguments:
+            field: Name of the field.
+            shape: Shape of the array.
+            dtype: Data type of the array. float by default.
+
+        Return:
+            Path to the .npy file of the field.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        self._fields.pop(field, None)
+        np.lib.format.open_memmap(self.field_path(field), mode="w+",
+                                  dtype=dtype, shape=shape).flush()
+        return self.field_path(field)
+
+    def remove(self, field):
+        """Delete a field from the store, if it exists.
+
+        Arguments:
+            field: Name of the field.
+        """
+        self._fields.pop(field, None)
+        if field in self:
+            os.remove(self.field_path(field))
+
+    def save(self, **fields):
+        """Save arrays as fields of the store, overwriting existing ones.
+
+        Arguments:
+            **fields: Named arrays to save.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        for field, array in fields.items():
+            self._fields.pop(field, None)
+            np.save(self.field_path(field), array)
+
+
+class SpectraStore(ProcessedStore):
+    """Directory with the power spectra and quality control flags of every
+    station, see quality.quality_control. Works like ProcessedStore.
+
+    Arguments:
+        path: Directory of the store. constants.SPECTRA_DIR by default.
+        mmap_mode: Mode the fields are memory mapped with. 'r' by default.
+    """
+    FIELDS = ("psd", "frequencies", "frame_power", "noise_floor", "dead",
+              "noisy", "gappy", "stations", "keys")
+
+    def __init__(self, path=None, mmap_mode="r"):
+        super().__init__(constants.SPECTRA_DIR if path is None else path, mmap_mode)
+
+
+class FilteredStore:
+    """Single memory mapped container with the filtered traces of all
+    stations, indexed by (filter, station).
+
+    The traces are kept in one .npy file of shape (n_filters, n_stations,
+    n_samples), next to a small JSON header recording the filter coefficients
+    and decimation factor used, and which stations are completed. store[j] gives filter j for all
+    stations, and store[:, i] all filters for station i.
+
+    Every station is completed with a key identifying its inputs, see
+    open_for_writing, so traces are only filtered again when their inputs
+    change.
+
+    Arguments:
+        path: Directory of the store. constants.FILTERED_DIR by default.
+        mmap_mode: Mode the traces are memory mapped with. 'r' by default.
+    """
+    def __init__(self, path=None, mmap_mode="r"):
+        self.path = constants.FILTERED_DIR if path is None else path
+        self.mmap_mode = mmap_mode
+        self._traces = None
+        with open(self.header_path) as file:
+            self.header = json.load(file)
+
+    @property
+    def traces_path(self):
+        return os.path.join(self.path, "traces.npy")
+
+    @property
+    def header_path(self):
+        return os.path.join(self.path, "header.json")
+
+    @classmethod
+    def open_for_writing(cls, h_list, keys, n_samples, dtype=float, path=None,
+                         decimation=1):
+        """Open a store to write filtered traces to, reusing an earlier run.
+
+        If a store made with the same filters, number of samples and data type
+        already exists, every station completed there with the same key is kept,
+        even if it has moved to another index. The remaining stations are left
+        to be written.
+
+        Arguments:
+            h_list: List of arrays representing the FIRs of the filters.
+            keys: Sequence of strings identifying the inputs of every station,
+                  e.g. digests of the processed data and the filters.
+            n_samples: Number of samples in every trace.
+            dtype: Data type of the traces. float by default.
+            path: Directory of the store. constants.FILTERED_DIR by default.
+            decimation: Factor the traces are decimated by after filtering.
+                        1 by default, meaning no decimation.
+
+        Return:
+            FilteredStore opened with mmap_mode 'r+'.
+        """
+        path = constants.FILTERED_DIR if path is None else path
+        keys = [str(key) for key in keys]
+        header = {"filters": [np.asarray(h, dtype=float).tolist() for h in h_list],
+                  "shape": [len(h_list), len(keys), n_samples],
+                  "dtype": np.dtype(dtype).str,
+                  "decimation": decimation,
+                  "targets": keys,
+                  "keys": [None]*len(keys)}
+
+        try:
+            old = cls(path, mmap_mode="r")
+            if not all(old.header.get(key) == header[key]
+                       for key in ("filters", "dtype", "decimation")) \
+               or old.shape[2] != n_samples:
+                old = None
+        except (FileNotFoundError, json.JSONDecodeError):
+            old = None
+
+        old_rows = {} if old is None else {key: i for i, key in enumerate(old.header["keys"])
+                                           if key is not None}
+        reused = [(i, old_rows[key]) for i, key in enumerate(keys) if key in old_rows]
+        for i, _ in reused:
+            header["keys"][i] = keys[i]
+
+        if old is not None and old.shape == tuple(header["shape"]) \
+           and all(i == j for i, j in reused):
+            # Every reused station is where it was, so the traces stay in place
+            _write_json(old.header_path, header)
+        else:
+            os.makedirs(path, exist_ok=True)
+            new_path = os.path.join(path, "traces.new.npy")
+            traces = np.lib.format.open_memmap(new_path, mode="w+", dtype=dtype,
+                                               shape=tuple(header["shape"]))
+            for i, j in reused:
+                traces[:, i] = old[:, j]
+            traces.flush()
+            del traces, old
+
+            # Invalidate the old header before replacing the traces it describes
+            _write_json(os.path.join(path, "header.json"),
+                        dict(header, keys=[None]*len(keys)))
+            os.replace(new_path, os.path.join(path, "traces.npy"))
+            _write_json(os.path.join(path, "header.json"), header)
+
+        cache.stats.hit("filter_signals", len(reused))
+        cache.stats.miss("filter_signals", len(keys) - len(reused))
+        return cls(path, mmap_mode="r+")
+
+    @property
+    def traces(self):
+        if self._traces is None:
+            self._traces = np.load(self.traces_path, mmap_mode=self.mmap_mode)
+        return self._traces
+
+    @property
+    def filters(self):
+        return [np.array(h) for h in self.header["filters"]]
+
+    @property
+    def decimation(self):
+        """Factor the traces are decimated by, relative to the processed data."""
+        return self.header.get("decimation", 1)
+
+    @property
+    def completed(self):
+        """Boolean array telling which stations have been filtered."""
+        return np.array([key is not None for key in self.header["keys"]], dtype=bool)
+
+    @property
+    def shape(self):
+        return tuple(self.header["shape"])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return self.traces[key]
+
+    def write(self, start, y):
+        """Write the filtered traces of a block of consecutive stations.
+
+        The traces are flushed to disk before the stations are marked as
+        completed in the header, so a crashed run never leaves a station
+        marked as completed with partially written traces.
+
+        Arguments:
+            start: Index of the first station in the block.
+            y: 3-d array with the filtered traces, indexed by (filter, station
+               in block, sample), like the output of
+               signal_processing.filter_bank.
+        """
+        stop = start + y.shape[1]
+        self.traces[:, start:stop] = y
+        self.traces.flush()
+        self.header["keys"][start:stop] = self.header["targets"][start:stop]
+        _write_json(self.header_path, self.header)
+
+
+def _write_json(path, content):
+    """Atomically replace a JSON file, so it is never left half written.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(content, file)
+    os.replace(tmp_path, path)
+
+
+class LodPyramid:
+    """Multi-resolution min/max envelopes of the traces in a FilteredStore,
+    cached on disk next to it.
+
+    Level k keeps the minimum and maximum of bins of base_factor*4**k samples,
+    so a plot can use the coarsest level that still has about one bin for
+    every pixel, instead of all the samples.
+
+    Arguments:
+        path: Directory of the pyramid. The lod subdirectory of
+              constants.FILTERED_DIR by default.
+    """
+    def __init__(self, path=None):
+        self.path = os.path.join(constants.FILTERED_DIR, "lod") if path is None else path
+        with open(os.path.join(self.path, "header.json")) as file:
+            self.header = json.load(file)
+        self.levels = [np.load(self.level_path(k), mmap_mode="r")
+                       for k in range(len(self.header["factors"]))]
+
+    def level_path(self, k):
+        return os.path.join(self.path, f"level_{k}.npy")
+
+    @property
+    def factors(self):
+        return self.header["factors"]
+
+    @classmethod
+    def open_or_build(cls, filtered, path=None, base_factor=8, min_bins=256,
+                      block_size=8):
+        """Open the pyramid of a filtered store, building it if it is missing
+        or was built from other filtered traces.
+
+        Arguments:
+            filtered: FilteredStore with all stations completed.
+            path: Directory of the pyramid. The lod subdirectory of the
+                  filtered store by default.
+            base_factor: Number of samples in every bin of the finest level.
+                         8 by default.
+            min_bins: Levels are added until they would have fewer bins than
+                      this. 256 by default.
+            block_size: Number of stations read at once while building. 8 by
+                        default.
+
+        Return:
+            LodPyramid
+        """
+        path = os.path.join(filtered.path, "lod") if path is None else path
+        source = {key: filtered.header.get(key) for key in ("filters", "shape", "dtype",
+                                                            "decimation", "keys")}
+        try:
+            pyramid = cls(path)
+            if pyramid.header["source"] == source:
+                return pyramid
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+        n_filters, n_stations, n_samples = filtered.shape
+        factors = [base_factor]
+        while -(-n_samples // (factors[-1]*4)) >= min_bins:
+            factors.append(factors[-1]*4)
+
+        os.makedirs(path, exist_ok=True)
+        levels = [np.lib.format.open_memmap(
+                      os.path.join(path, f"level_{k}.npy"), mode="w+",
+                      dtype=filtered.traces.dtype,
+                      shape=(n_filters, n_stations, -(-n_samples // factor), 2))
+                  for k, factor in enumerate(factors)]
+
+        for start in range(0, n_stations, block_size):
+            block = filtered[:, start:start + block_size]
+            lower, upper = signal_processing.minmax_envelope(block, base_factor)
+            for k, level in enumerate(levels):
+                if k > 0:
+                    lower = signal_processing.minmax_envelope(lower, 4)[0]
+                    upper = signal_processing.minmax_envelope(upper, 4)[1]
+                level[:, start:start + block_size, :, 0] = lower
+                level[:, start:start + block_size, :, 1] = upper
+
+        for level in levels:
+            level.flush()
+        _write_json(os.path.join(path, "header.json"),
+                    {"source": source, "factors": factors})
+        return cls(path)
+
+    def envelope(self, filter_index, station, n_points, start=0, stop=None,
+                 filtered=None):
+        """Get a min/max envelope of a trace, with about n_points bins.
+
+        Uses the coarsest level with at least n_points bins between sample
+        start and stop. If no level is fine enough, the samples themselves are
+        returned as an envelope with bins of one sample if filtered is given,
+        and otherwise the finest level is used.
+
+        Arguments:
+            filter_index: Index of the filter.
+            station: Index of the station.
+            n_points: Minimum number of bins wanted, e.g. the pixel width of
+                      the plot.
+            start: First sample of the range wanted. 0 by default.
+            stop: Sample after the range wanted. None by default, meaning the
+                  end of the trace.
+            filtered: FilteredStore the pyramid is built from. Optional.
+
+        Return:
+            Tuple with the index of the first sample of every bin, and the
+            minimum and maximum of every bin.
+        """
+        n_samples = self.header["source"]["shape"][2]
+        stop = n_samples if stop is None else stop
+
+        for k in reversed(range(len(self.factors))):
+            factor = self.factors[k]
+            first, last = start // factor, -(-stop // factor)
+            if last - first >= n_points or (k == 0 and filtered is None):
+                level = self.levels[k][filter_index, station, first:last]
+                return np.arange(first, last)*factor, level[:, 0], level[:, 1]
+
+        trace = filtered[filter_index, station, start:stop]
+        return np.arange(start, stop), trace, trace
+
+
+class CorrelationStore:
+    """Cache of the cross-correlations between pairs of stations, see
+    refinement.refine_arrival_times.
+
+    Every pair is stored under a key identifying its traces and the windows
+    correlated, so only pairs where one of them changed are correlated again.
+    Only the pairs of the last run are kept.
+
+    Arguments:
+        path: Directory of the store. constants.CORRELATIONS_DIR by default.
+    """
+    FIELDS = ("lags", "coefficients")
+
+    def __init__(self, path=None):
+        self.path = constants.CORRELATIONS_DIR if path is None else path
+
+    def field_path(self, field):
+        return os.path.join(self.path, f"{field}.npy")
+
+    def lookup(self, keys):
+        """Get the stored results for some pairs.
+
+        Arguments:
+            keys: Sequence of strings identifying the pairs.
+
+        Return:
+            Boolean array telling which pairs were found, and arrays with
+            their lags and coefficients, which are 0 where not found.
+        """
+        found = np.zeros(len(keys), dtype=bool)
+        fields = {field: np.zeros(len(keys), dtype=float) for field in self.FIELDS}
+        try:
+            stored_keys = np.load(self.field_path("keys"))
+            stored = {field: np.load(self.field_path(field)) for field in self.FIELDS}
+        except FileNotFoundError:
+            return (found,) + tuple(fields.values())
+
+        rows = {key: row for row, key in enumerate(stored_keys)}
+        for i, key in enumerate(keys):
+            if key in rows:
+                found[i] = True
+                for field in self.FIELDS:
+                    fields[field][i] = stored[field][rows[key]]
+        return (found,) + tuple(fields.values())
+
+    def save(self, keys, lags, coefficients):
+        """Replace the stored pairs.
+
+        Arguments:
+            keys: Sequence of strings identifying the pairs.
+            lags: Array with the lag of every pair.
+            coefficients: Array with the correlation coefficient of every pair.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        # The keys are removed first and saved last, marking the store as complete
+        if os.path.exists(self.field_path("keys")):
+            os.remove(self.field_path("keys"))
+        np.save(self.field_path("lags"), lags)
+        np.save(self.field_path("coefficients"), coefficients)
+        np.save(self.field_path("keys"), np.array(keys, dtype=str))
+
+
+class BasemapCache:
+    """Cache of background rasters of maps, already reprojected to the
+    projection of the map, see plot.stock_basemap.
+
+    Every raster is saved in its own file, named by a key identifying the
+    projection and size of the map, so maps of different events are kept
+    side by side.
+
+    Arguments:
+        path: Directory of the cache. constants.BASEMAP_DIR by default.
+    """
+    def __init__(self, path=None):
+        self.path = constants.BASEMAP_DIR if path is None else path
+
+    def file_path(self, key):
+        return os.path.join(self.path, f"{key}.npz")
+
+    def load(self, key):
+        """Get a stored raster.
+
+        Arguments:
+            key: String identifying the raster.
+
+        Return:
+            Tuple with the RGBA image as a 3-d uint8 array, and its extent in
+            the coordinates of the projection, or None if it isn't stored.
+        """
+        try:
+            with np.load(self.file_path(key)) as stored:
+                return stored["image"], tuple(stored["extent"])
+        except FileNotFoundError:
+            return None
+
+    def save(self, key, image, extent):
+        """Store a raster.
+
+        Arguments:
+            key: String identifying the raster.
+            image: 3-d uint8 array with the RGBA image.
+            extent: Tuple with the extent of the image, like for imshow.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        # Written to a temporary file of this writer first, so other processes
+        # drawing the same map at the same time never read or overwrite half a
+        # file
+        tmp_path = self.file_path(f"{key}.{os.getpid()}.tmp")
+        np.savez(tmp_path, image=image, extent=np.array(extent, dtype=float))
+        os.replace(tmp_path, self.file_path(key))
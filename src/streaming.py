@@ -0,0 +1,300 @@
+"""Filtering and picking of waveforms arriving in chunks, for monitoring.
+
+The results are the same as filtering complete recordings with
+--filter-signals, and picking them with --pick-arrival-times, but only the
+state needed to continue between chunks is kept in memory.
+"""
+import os
+import glob
+import time
+import socket
+
+import numpy as np
+
+import signal_processing
+
+
+class StreamingFilter:
+    """Filter chunks of signals from many stations with several FIR filters,
+    keeping the state between chunks.
+
+    Uses overlap-save: the last samples of the previous chunk are put in front
+    of every new one, so each chunk gives exactly as many samples of the full
+    convolution as it has samples. The output is aligned like
+    signal_processing.convolution(x, h, ylen_choice=False), which lags the
+    input by half the filter length.
+
+    Arguments:
+        h_list: List of arrays representing the FIRs of the filters.
+        n_stations: Number of stations in every chunk.
+    """
+    def __init__(self, h_list, n_stations):
+        self.h_list = [np.asarray(h, dtype=float) for h in h_list]
+        self.n_stations = n_stations
+        self.history_len = max(len(h) for h in self.h_list) - 1
+        self.offsets = [(len(h) - 1)//2 for h in self.h_list]
+        self.history = np.zeros((n_stations, self.history_len), dtype=float)
+        self.n_input = 0
+        # Filtered samples not yet emitted, because other filters lag more
+        self.pending = [np.zeros((n_stations, 0)) for _ in self.h_list]
+        self.n_emitted = 0
+
+    @property
+    def latency(self):
+        """Number of samples the output lags the input."""
+        return max(self.offsets)
+
+    def process(self, chunk):
+        """Filter a new chunk of samples.
+
+        Arguments:
+            chunk: 2-d array with the next samples of every station.
+
+        Return:
+            3-d array indexed by (filter, station, sample) with the filtered
+            samples completed by this chunk, starting at sample n_emitted
+            (before the call) of the output.
+        """
+        chunk = np.asarray(chunk, dtype=float)
+        extended = np.concatenate((self.history, chunk), axis=1)
+
+        for j, h in enumerate(self.h_list):
+            # The full convolution for the samples of this chunk
+            start = self.history_len - (len(h) - 1)
+            full = np.array([signal_processing.convolution(x[start:], h)
+                             [len(h) - 1:len(h) - 1 + chunk.shape[1]]
+                             for x in extended])
+            # Drop the samples before the start of the centered output
+            skip = max(0, self.offsets[j] - self.n_input)
+            self.pending[j] = np.concatenate((self.pending[j], full[:, skip:]),
+                                             axis=1)
+
+        self.history = extended[:, extended.shape[1] - self.history_len:]
+        self.n_input += chunk.shape[1]
+        return self._emit()
+
+    def finish(self):
+        """Flush the last filtered samples at the end of the recordings.
+
+        Return:
+            3-d array like process, with the remaining samples, so the total
+            output is as long as the total input.
+        """
+        n_input, n_emitted = self.n_input, self.n_emitted
+        y = self.process(np.zeros((self.n_stations, self.latency)))
+        self.n_input = self.n_emitted = n_input
+        return y[:, :, :n_input - n_emitted]
+
+    def _emit(self):
+        n_ready = min(pending.shape[1] for pending in self.pending)
+        y = np.array([pending[:, :n_ready] for pending in self.pending])
+        self.pending = [pending[:, n_ready:] for pending in self.pending]
+        self.n_emitted += n_ready
+        return y
+
+
+class StreamingPicker:
+    """Running version of picking.pick_arrival_times, for signals arriving in
+    chunks.
+
+    Keeps only the cumulative energy of the last long plus short term window
+    of samples, and the best pick so far, for every station. At the end of the
+    recordings the picks are the same as the batch picker gives.
+
+    Arguments:
+        times: time_axis.TimeAxis with the times of the signals.
+        sta_window: Length of the short term window in seconds. 600 by default.
+        lta_window: Length of the long term window in seconds. 3600 by default.
+        saturation_ratio: Peak ratio giving a confidence of 1. 10 by default.
+        min_time: Ignore everything before this time, given in seconds since
+                  the UNIX epoch. None by default, meaning nothing is ignored.
+    """
+    def __init__(self, times, sta_window=600, lta_window=3600,
+                 saturation_ratio=10, min_time=None):
+        self.times = times
+        self.saturation_ratio = saturation_ratio
+        self.min_time = min_time
+        self.n_sta = np.maximum(1, np.round(sta_window/times.deltas)).astype(int)
+        self.n_lta = np.maximum(1, np.round(lta_window/times.deltas)).astype(int)
+
+        n_stations = len(times)
+        # Cumulative energy, for the samples from energy_start on
+        self.energy = np.zeros((n_stations, 1), dtype=float)
+        self.energy_start = 0
+        self.n_input = 0
+        # First sample whose ratio isn't evaluated yet
+        self.next_sample = 0
+
+        self.peak_samples = np.zeros(n_stations, dtype=int)
+        self.peak_ratios = np.zeros(n_stations, dtype=float)
+
+    def update(self, y, final=False):
+        """Add the next filtered samples of every station.
+
+        Arguments:
+            y: 2-d array with the next filtered samples of every station.
+            final: Whether these are the last samples. False by default.
+
+        Return:
+            Arrays with the best arrival time, and its confidence between 0
+            and 1, for every station so far.
+        """
+        y = np.asarray(y, dtype=float)
+        new_energy = self.energy[:, -1:] + np.cumsum(np.square(y), axis=1)
+        self.energy = np.concatenate((self.energy, new_energy), axis=1)
+        self.n_input += y.shape[1]
+
+        # Ratios need the short term window after the sample to be complete
+        stop = self.n_input if final else self.n_input - np.max(self.n_sta) + 1
+        if stop > self.next_sample:
+            self._evaluate(self.next_sample, stop)
+            self.next_sample = stop
+
+        # Keep what is needed for the long term window of the next sample
+        keep_from = max(0, self.next_sample - np.max(self.n_lta)) - self.energy_start
+        self.energy = self.energy[:, keep_from:]
+        self.energy_start += keep_from
+
+        return self.result()
+
+    def _evaluate(self, start, stop):
+        samples = np.arange(start, stop)[np.newaxis, :]
+        n_sta, n_lta = self.n_sta[:, np.newaxis], self.n_lta[:, np.newaxis]
+
+        def energy_at(indices):
+            indices = np.clip(indices, self.energy_start, self.energy_start
+                              + self.energy.shape[1] - 1)
+            return np.take_along_axis(self.energy, indices - self.energy_start, axis=1)
+
+        before = energy_at(np.broadcast_to(samples, (len(self.n_sta), stop - start)))
+        sta = (energy_at(samples + n_sta) - before)/n_sta
+        lta = (before - energy_at(samples - n_lta))/n_lta
+        ratio = np.divide(sta, lta, out=np.zeros_like(sta), where=lta > 0)
+
+        valid = ((samples >= n_lta) & (samples + n_sta <= self.n_input)
+                 & (samples < self.times.lengths[:, np.newaxis]))
+        if self.min_time is not None:
+            valid &= self.times.at(samples) >= self.min_time
+        ratio[~valid] = 0
+
+        peaks = np.argmax(ratio, axis=1)
+        peak_ratios = ratio[np.arange(len(peaks)), peaks]
+        better = peak_ratios > self.peak_ratios
+        self.peak_ratios[better] = peak_ratios[better]
+        self.peak_samples[better] = start + peaks[better]
+
+    def result(self):
+        """Get the best arrival time, and its confidence, for every station.
+        """
+        arrival_times = self.times.at(self.peak_samples)
+        confidences = np.clip((self.peak_ratios - 1)/(self.saturation_ratio - 1), 0, 1)
+        return arrival_times, confidences
+
+
+def directory_source(path, poll_interval=1.0, end_filename="end"):
+    """Read chunks of samples from .npy files in a directory as they appear.
+
+    The files are read in sorted order, and each must hold a 2-d array with
+    the next samples of every station. The stream ends when a file named
+    end_filename appears, and all other files are read.
+
+    Arguments:
+        path: Directory with the chunk files.
+        poll_interval: Seconds to wait before looking for new files. 1 by
+                       default.
+        end_filename: Name of the file marking the end of the stream. 'end' by
+                      default.
+
+    Return:
+        Generator of 2-d arrays.
+    """
+    read = set()
+    while True:
+        ended = os.path.exists(os.path.join(path, end_filename))
+        new_files = sorted(set(glob.glob(os.path.join(path, "*.npy"))) - read)
+        for filename in new_files:
+            read.add(filename)
+            yield np.load(filename)
+        if ended:
+            return
+        if not new_files:
+            time.sleep(poll_interval)
+
+
+def socket_source(address):
+    """Read chunks of samples sent as .npy-serialized arrays over a socket.
+
+    The stream ends when the sender closes the connection.
+
+    Arguments:
+        address: Tuple with the host and port to connect to.
+
+    Return:
+        Generator of 2-d arrays.
+    """
+    with socket.create_connection(address) as connection:
+        stream = connection.makefile("rb")
+        while stream.peek(1):
+            # read_array can't be used, as it needs a seekable file
+            version = np.lib.format.read_magic(stream)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(stream)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(stream)
+            count = int(np.prod(shape))
+            array = np.frombuffer(stream.read(count*dtype.itemsize), dtype=dtype,
+                                  count=count)
+            yield array.reshape(shape, order="F" if fortran_order else "C")
+
+
+def write_chunks(data, path, chunk_size):
+    """Split recordings into chunk files that directory_source can read, e.g.
+    to replay the processed data as a stream.
+
+    Arguments:
+        data: 2-d array with the samples of every station.
+        path: Directory to write the chunk files to.
+        chunk_size: Number of samples in every chunk.
+    """
+    os.makedirs(path, exist_ok=True)
+    for i, start in enumerate(range(0, data.shape[1], chunk_size)):
+        np.save(os.path.join(path, f"{i:08}.npy"), data[:, start:start + chunk_size])
+    open(os.path.join(path, "end"), "w").close()
+
+
+def run(source, h_list, times, output_filename=None, **picker_args):
+    """Filter and pick arrival times from a stream of chunks.
+
+    Arguments:
+        source: Iterable of 2-d arrays with the next samples of every station,
+                e.g. from directory_source or socket_source.
+        h_list: List of arrays representing the FIRs of the filters.
+        times: time_axis.TimeAxis with the times of the signals.
+        output_filename: Path to a .npy file to write the filtered signals to,
+                         indexed like a storage.FilteredStore. None by default,
+                         meaning they aren't saved.
+        **picker_args: Arguments passed on to StreamingPicker.
+
+    Return:
+        Generator giving, after every chunk, the filtered block completed by
+        it, and the arrival times and confidences picked so far. The
+        pick is done on the second filter.
+    """
+    stream_filter = StreamingFilter(h_list, len(times))
+    picker = StreamingPicker(times, **picker_args)
+    output = None
+    if output_filename is not None:
+        output = np.lib.format.open_memmap(output_filename, mode="w+", dtype=float,
+                                           shape=(len(h_list),) + times.shape)
+
+    def emit(y, final=False):
+        if output is not None:
+            start = stream_filter.n_emitted - y.shape[2]
+            output[:, :, start:start + y.shape[2]] = y
+            if final:
+                output.flush()
+        return (y,) + picker.update(y[1], final=final)
+
+    for chunk in source:
+        yield emit(stream_filter.process(chunk))
+    yield emit(stream_filter.finish(), final=True)
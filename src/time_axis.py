@@ -0,0 +1,120 @@
+"""Compact representation of the times of all the measurements.
+"""
+import numpy as np
+
+
+class TimeAxis:
+    """Lazy stand-in for a 2-d array with the times of each measurement.
+
+    Every station is described only by its start time, the time between
+    samples and the number of valid samples. Rows are built when they are
+    indexed, and are equal to the rows of the dense 'times'-array previously
+    stored by process_data, including the zero padding after the valid samples.
+
+    Arguments:
+        starttimes: 1-d array with the start time of each station, in seconds
+                    since the UNIX epoch.
+        deltas: 1-d array with the time between samples for each station.
+        lengths: 1-d integer array with the number of valid samples for each
+                 station.
+        n_samples: Length of every row.
+    """
+    def __init__(self, starttimes, deltas, lengths, n_samples):
+        self.starttimes = np.asarray(starttimes, dtype=float)
+        self.deltas = np.asarray(deltas, dtype=float)
+        self.lengths = np.asarray(lengths, dtype=int)
+        self.n_samples = int(n_samples)
+
+    @classmethod
+    def from_processed(cls, processed_data):
+        """Make a time axis from the fields saved by process_data.
+
+        Arguments:
+            processed_data: Mapping with the fields 'starttimes', 'deltas',
+                            'lengths' and 'n_samples'.
+        """
+        return cls(processed_data["starttimes"], processed_data["deltas"],
+                   processed_data["lengths"], processed_data["n_samples"])
+
+    @property
+    def shape(self):
+        return (len(self.starttimes), self.n_samples)
+
+    @property
+    def steps(self):
+        """Time between consecutive samples of every station. Rows are built
+        with linspace, so this is delta*length/(length - 1)."""
+        return self.deltas*self.lengths/np.maximum(self.lengths - 1, 1)
+
+    def __len__(self):
+        return len(self.starttimes)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.row(i)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.array([self.row(i) for i in range(len(self))], dtype=dtype)
+
+    def row(self, i):
+        """Build the times of the measurements of a single station.
+
+        Arguments:
+            i: Index of the station.
+
+        Return:
+            1-d array of length n_samples.
+        """
+        length = self.lengths[i]
+        times = np.zeros(self.n_samples, dtype=float)
+        times[:length] = self.starttimes[i] + np.linspace(0, self.deltas[i]*length,
+                                                          length)
+        return times
+
+    def at(self, samples):
+        """Get the times of given samples of every station, without building
+        the rows.
+
+        Arguments:
+            samples: Array of sample indices, broadcastable against a column
+                     with one entry for each station.
+
+        Return:
+            Array with the times, 0 for samples after the valid ones.
+        """
+        samples = np.asarray(samples)
+        lengths = self.lengths.reshape((-1,) + (1,)*max(samples.ndim - 1, 0))
+        starttimes = self.starttimes.reshape(lengths.shape)
+        steps = self.steps.reshape(lengths.shape)
+        return np.where(samples < lengths, starttimes + samples*steps, 0)
+
+    def decimate(self, factor):
+        """Get the time axis of the signals decimated by a factor, see
+        signal_processing.decimate.
+
+        Arguments:
+            factor: Integer decimation factor.
+
+        Return:
+            TimeAxis where sample k of every row has the time of sample
+            k*factor of this one.
+        """
+        if factor == 1:
+            return self
+        lengths = -(-self.lengths // factor)
+        steps = factor*self.steps
+        deltas = steps*np.maximum(lengths - 1, 1)/np.maximum(lengths, 1)
+        return TimeAxis(self.starttimes, deltas, lengths, -(-self.n_samples // factor))
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            station, samples = key[0], key[1:]
+            if isinstance(station, (int, np.integer)):
+                return self.row(station)[samples]
+            return np.asarray(self[station])[(slice(None),) + samples]
+
+        if isinstance(key, (int, np.integer)):
+            return self.row(key)
+
+        return TimeAxis(self.starttimes[key], self.deltas[key],
+                        self.lengths[key], self.n_samples)
@@ -0,0 +1,170 @@
+"""Uncertainty of the line fitted to the arrival times against the distances
+of the stations, from bootstrap and jackknife resampling of the stations.
+
+Every resample is a weighted least squares fit of the same points with other
+weights, so all of them are solved at once from the weighted sums of the
+points, with one matrix product per sum, instead of one fit at a time.
+"""
+import warnings
+
+import numpy as np
+
+
+def weighted_line_fits(x, y, weights):
+    """Fit lines y = intercept + slope*x to the same points with many sets of
+    weights.
+
+    Solves the 2x2 normal equations of every set of weights in closed form.
+
+    Arguments:
+        x: 1-d array with the x-coordinates of the points. Should be centered
+           on 0 for accuracy, e.g. UNIX times minus their mean.
+        y: 1-d array with the y-coordinates of the points.
+        weights: 2-d array with one set of weights of the squared residuals
+                 for every fit, indexed by (fit, point).
+
+    Return:
+        Arrays with the intercept and slope of every fit, which are NaN for
+        fits with fewer than two distinct x-coordinates weighted.
+    """
+    s0 = np.sum(weights, axis=1)
+    sx = weights @ x
+    sy = weights @ y
+    sxx = weights @ (x*x)
+    sxy = weights @ (x*y)
+
+    determinant = s0*sxx - sx**2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        valid = determinant > 1e-12*np.maximum(s0*sxx, np.finfo(float).tiny)
+        determinant = np.where(valid, determinant, np.nan)
+        intercepts = (sxx*sy - sx*sxy)/determinant
+        slopes = (s0*sxy - sx*sy)/determinant
+    return intercepts, slopes
+
+
+def bootstrap_weights(n_points, n_resamples, rng):
+    """Get the weights of bootstrap resamples, the number of times every point
+    is drawn, with replacement, into a resample of the same size.
+
+    Arguments:
+        n_points: Number of points.
+        n_resamples: Number of resamples.
+        rng: numpy.random.Generator.
+
+    Return:
+        2-d array indexed by (resample, point).
+    """
+    if n_points == 0:
+        return np.zeros((n_resamples, 0))
+    return rng.multinomial(n_points, np.full(n_points, 1/n_points),
+                           size=n_resamples).astype(float)
+
+
+def jackknife_weights(n_points):
+    """Get the weights of jackknife resamples, each leaving out one point.
+
+    Return:
+        2-d array indexed by (resample, point).
+    """
+    return 1 - np.eye(n_points)
+
+
+def jackknife_error(values):
+    """Get the jackknife estimate of the standard error of a statistic, from
+    its values for every jackknife resample. NaN values are left out.
+    """
+    values = values[np.isfinite(values)]
+    n = len(values)
+    if n < 2:
+        return np.nan
+    return np.sqrt((n - 1)/n*np.sum((values - np.mean(values))**2))
+
+
+def line_fit_uncertainty(times, distances, weights=None, n_resamples=2000,
+                         confidence=0.95, seed=0):
+    """Fit the distances of the stations against the arrival times at them
+    with a line, and estimate the uncertainty of the propagation speed and
+    origin time.
+
+    The fit is the same as np.polynomial.polynomial.Polynomial.fit with deg=1
+    and w=weights. The confidence intervals are percentiles of bootstrap
+    resamples of the stations, and the standard errors are from jackknife
+    resamples.
+
+    Arguments:
+        times: 1-d array with the arrival times in seconds.
+        distances: 1-d array with the distances of the stations.
+        weights: 1-d array with the weight of every station, applied to the
+                 unsquared residuals like in Polynomial.fit, e.g. from
+                 picking.validness_to_weights. None by default, meaning all
+                 are weighted equally. Stations with weight 0 are left out.
+        n_resamples: Number of bootstrap resamples. 2000 by default.
+        confidence: Confidence level of the intervals. 0.95 by default.
+        seed: Seed of the random resamples. 0 by default.
+
+    Return:
+        Dictionary with the speed in units of distance per second and the
+        origin time of the fit, their confidence intervals as (lower, upper)
+        under "speed_interval" and "origin_time_interval", their standard
+        errors under "speed_error" and "origin_time_error", and the intercepts
+        and slopes of the bootstrap fits relative to the time "reference",
+        e.g. for line_band. Everything is NaN if fewer than two stations
+        have a weight above 0.
+    """
+    times = np.asarray(times, dtype=float)
+    distances = np.asarray(distances, dtype=float)
+    weights = np.ones_like(times) if weights is None else np.asarray(weights, dtype=float)
+    used = weights > 0
+    times, distances, weights = times[used], distances[used], weights[used]**2
+
+    # Subtracting the mean time keeps the sums accurate for UNIX times
+    reference = np.sum(weights*times)/np.sum(weights) if len(times) else 0.0
+    x = times - reference
+
+    rng = np.random.default_rng(seed)
+    resamples = np.concatenate((weights[np.newaxis, :],
+                                jackknife_weights(len(x))*weights,
+                                bootstrap_weights(len(x), n_resamples, rng)*weights))
+    intercepts, slopes = weighted_line_fits(x, distances, resamples)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        origin_times = reference - intercepts/slopes
+
+    jackknife = slice(1, 1 + len(x))
+    bootstrap = slice(1 + len(x), None)
+    tails = 100*np.array([(1 - confidence)/2, (1 + confidence)/2])
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        speed_interval = np.nanpercentile(slopes[bootstrap], tails)
+        origin_time_interval = np.nanpercentile(origin_times[bootstrap], tails)
+
+    return {"speed": float(slopes[0]),
+            "origin_time": float(origin_times[0]),
+            "speed_interval": tuple(speed_interval.tolist()),
+            "origin_time_interval": tuple(origin_time_interval.tolist()),
+            "speed_error": float(jackknife_error(slopes[jackknife])),
+            "origin_time_error": float(jackknife_error(origin_times[jackknife])),
+            "reference": reference,
+            "intercepts": intercepts[bootstrap],
+            "slopes": slopes[bootstrap]}
+
+
+def line_band(fit, times, confidence=0.95):
+    """Get the confidence band of the fitted line, from the bootstrap fits.
+
+    Arguments:
+        fit: Dictionary from line_fit_uncertainty.
+        times: 1-d array with the times to get the band at.
+        confidence: Confidence level of the band. 0.95 by default.
+
+    Return:
+        Arrays with the lower and upper distance of the band at every time.
+    """
+    x = np.asarray(times, dtype=float) - fit["reference"]
+    lines = fit["intercepts"][:, np.newaxis] + fit["slopes"][:, np.newaxis]*x
+    tails = 100*np.array([(1 - confidence)/2, (1 + confidence)/2])
+    with warnings.catch_warnings():
+        # Every bootstrap fit is NaN if there were too few stations
+        warnings.simplefilter("ignore", RuntimeWarning)
+        lower, upper = np.nanpercentile(lines, tails, axis=0)
+    return lower, upper